@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
-from utils import config
-from threading import Thread
-from utils.mqtt_client import mqtt_sensor
+from utils import log
+from utils.snapshots import since_start
+from utils.reload import supervisor
 import os
 
 
@@ -15,25 +15,8 @@ def my_import(name):
 
 
 def run_sensors():
-    threads = []
-    with open('config/sensors.json') as cf:
-        conf = config(cf)
-        for name in conf.sources:
-            actor = mqtt_sensor(conf, name)
-            if not actor.disabled and actor.sensor_ok():
-                thread = Thread(target=actor.run,
-                                daemon=True,
-                                name=f'{name}_thread')
-                threads.append(thread)
-
-    for thread in threads:
-        print(f'Starting thread {thread.name}')
-        thread.start()
-
-    print('Threads started')
-
-    for thread in threads:
-        thread.join()
+    log(f'Startup phase imports at {since_start()} s')
+    supervisor('config/sensors.json').run()
 
 
 print(f'PID: {os.getpid()}')
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+from utils.bus import data_bus
+import numpy as np
+
+
+def test_unchanged_value_keeps_version():
+    bus = data_bus()
+    first = bus.publish('spotprice/curve', {'start': 0, 'values': [1, 2]})
+    again = bus.publish('spotprice/curve', {'start': 0, 'values': [1, 2]})
+    assert again is first
+    assert not bus.wait(['spotprice/curve'], first.version, timeout=0.01)
+
+
+def test_changed_value_wakes():
+    bus = data_bus()
+    first = bus.publish('currency', {'eur_to_sek': 11.2})
+    bus.publish('currency', {'eur_to_sek': 11.3})
+    assert bus.wait(['currency'], first.version, timeout=0.01)
+    assert bus.value('currency')['eur_to_sek'] == 11.3
+
+
+def test_equal_but_different_type_is_a_change():
+    bus = data_bus()
+    first = bus.publish('x', 1)
+    assert bus.publish('x', 1.0) is not first
+    assert bus.publish('x', True).value is True
+
+
+def test_arrays_always_publish():
+    bus = data_bus()
+    first = bus.publish('plan', np.zeros(3))
+    assert bus.publish('plan', np.zeros(3)).version > first.version
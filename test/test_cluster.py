@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+from utils.cluster import lease
+from utils.mqtt_client import mqtt_sensor
+import time
+
+PERIOD = 60
+T0 = 1_000_000
+
+
+class retained_topic:
+    """Broker stand-in for one lease topic: keeps the last retained
+    payload, hands it to late subscribers and delivers every publish to
+    all subscribers, in publish order, like a single broker does."""
+
+    def __init__(self):
+        self.payload = None
+        self.subscribers = []
+
+    def subscribe(self, node: lease):
+        self.subscribers.append(node)
+        if self.payload is not None:
+            node.on_message(self.payload)
+
+    def publish(self, payload):
+        self.payload = payload
+        for node in self.subscribers:
+            node.on_message(payload)
+
+
+def cluster(*names):
+    topic = retained_topic()
+    nodes = [lease('spotprice', name, period=PERIOD) for name in names]
+    for node in nodes:
+        topic.subscribe(node)
+    return topic, nodes
+
+
+def tick(topic, nodes, now):
+    """One pass of every node's lease loop"""
+    for node in nodes:
+        if claim := node.claim(now):
+            topic.publish(claim)
+
+
+def owners(nodes, now):
+    return [node.node for node in nodes if node.owned(now)]
+
+
+def test_concurrent_claims_one_owner():
+    topic, nodes = cluster('a', 'b', 'c')
+    tick(topic, nodes, T0)
+    assert len(owners(nodes, T0)) == 1
+    assert len({node.holder for node in nodes}) == 1
+
+
+def test_holder_renews():
+    topic, nodes = cluster('a', 'b')
+    holder = None
+    for k in range(20):
+        now = T0 + k * PERIOD / 6
+        tick(topic, nodes, now)
+        assert len(owners(nodes, now)) == 1
+        holder = holder or owners(nodes, now)[0]
+        assert owners(nodes, now) == [holder]
+
+
+def test_takeover_after_expiry():
+    topic, nodes = cluster('a', 'b', 'c')
+    tick(topic, nodes, T0)
+    dead = next(node for node in nodes if node.owned(T0))
+    alive = [node for node in nodes if node is not dead]
+    expires = dead.expires
+    # The holder stops renewing, the others wait for its lease to expire
+    now = T0
+    while now < expires - 1:
+        now += PERIOD / 6
+        tick(topic, alive, min(now, expires - 1))
+        assert not owners(alive, min(now, expires - 1))
+    tick(topic, alive, expires + 1)
+    assert len(owners(alive, expires + 1)) == 1
+    assert not dead.owned(expires + 1)
+
+
+def test_takeover_within_one_period():
+    topic, nodes = cluster('a', 'b')
+    tick(topic, nodes, T0)
+    dead = next(node for node in nodes if node.owned(T0))
+    other = next(node for node in nodes if node is not dead)
+    # The holder renews once more and dies, the other node's lease loop,
+    # running out of phase, wakes up at expiry at the latest
+    renewed = T0 + PERIOD / 3
+    tick(topic, [dead], renewed)
+    now = T0 + 1
+    while not other.owned(now):
+        now += other.wait(now)
+        tick(topic, [other], now)
+    assert now <= renewed + PERIOD
+
+
+def test_expired_holder_does_not_own():
+    topic, nodes = cluster('a')
+    tick(topic, nodes, T0)
+    assert nodes[0].owned(T0)
+    # No renewal, e.g. disconnected from the broker
+    assert not nodes[0].owned(T0 + PERIOD + 1)
+
+
+def test_release_hands_over():
+    topic, nodes = cluster('a', 'b')
+    tick(topic, nodes, T0)
+    holder = next(node for node in nodes if node.owned(T0))
+    other = next(node for node in nodes if node is not holder)
+    topic.publish(holder.release())
+    assert not owners(nodes, T0 + 1)
+    tick(topic, [other], T0 + 1)
+    assert owners(nodes, T0 + 1) == [other.node]
+
+
+def test_late_joiner_sees_retained_lease():
+    topic, nodes = cluster('a')
+    tick(topic, nodes, T0)
+    late = lease('spotprice', 'b', period=PERIOD)
+    topic.subscribe(late)
+    assert late.holder == 'a'
+    assert late.claim(T0 + 1) is None
+
+
+class leased_sensor(mqtt_sensor):
+    """Only the replay path, no broker connection"""
+
+    def __init__(self, node: lease):
+        self.lease = node
+        self.sent = []
+
+    def __del__(self):
+        pass
+
+    def resend(self, topic, payload, qos, retain):
+        self.sent.append(payload)
+        return True
+
+
+def test_expired_holder_drops_queued_state():
+    topic, nodes = cluster('a', 'b')
+    now = time.time()
+    tick(topic, nodes[:1], now)
+    sensor = leased_sensor(nodes[0])
+    assert sensor.replay_send('spotprice', '1', 1, True)
+    assert sensor.sent == ['1']
+    # Cut off from the broker for longer than the lease, b has taken
+    # over, what a queued meanwhile is stale and dropped
+    tick(topic, nodes[1:], nodes[0].expires + 1)
+    assert sensor.replay_send('spotprice', '0', 1, True)
+    assert sensor.sent == ['1']
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from utils.spot_price import Entsoe, parse_day_ahead
+import gzip
+import pandas as pd
+
+FIXTURE = Path(__file__).parent / 'fixtures' / 'entsoe_a44.xml'
+# 2026-11-02 00:00 local
+START = pd.Timestamp('2026-11-01T23:00Z')
+
+
+def parse(minutes):
+    with FIXTURE.open('rb') as fp:
+        return parse_day_ahead(fp, minutes)
+
+
+def test_mixed_resolutions():
+    prices, seen = parse(60)
+    assert seen == {'PT60M', 'PT15M'}
+    assert prices.index[0] == START
+    assert (prices.index[1:] - prices.index[:-1] ==
+            pd.Timedelta(minutes=60)).all()
+    prices, _ = parse(15)
+    assert len(prices) == 8
+    assert (prices.index[1:] - prices.index[:-1] ==
+            pd.Timedelta(minutes=15)).all()
+
+
+def test_missing_positions_repeat_previous_price():
+    # Curve type A03 leaves out positions 3 and 8
+    prices, _ = parse(15)
+    assert list(prices) == [1, 2, 2, 4, 5, 6, 7, 7]
+
+
+def test_first_series_wins():
+    # The third series repeats the first two hours with other prices
+    prices, _ = parse(60)
+    assert list(prices) == [10.5, 20.25, 30]
+
+
+def test_no_resolution():
+    prices, seen = parse(30)
+    assert not len(prices)
+    assert seen == {'PT60M', 'PT15M'}
+
+
+class failing_client:
+    """Fetch wraps errors, so calls are also counted"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def query_day_ahead_prices(self, *args):
+        self.calls += 1
+        raise AssertionError('cached document was not used')
+
+
+def test_cached_document(tmp_path):
+    entsoe = Entsoe.__new__(Entsoe)
+    entsoe.zone = 'SE_3'
+    entsoe.minutes = 60
+    entsoe.step = pd.Timedelta(minutes=60)
+    entsoe.raw_cache = tmp_path
+    entsoe.client = failing_client()
+    start = START.tz_convert('Europe/Stockholm')
+    end = start + pd.Timedelta(hours=3)
+    entsoe.period = lambda: (start, end)
+    path = entsoe.raw_path(start, end)
+    with gzip.open(path, 'wb') as fp:
+        fp.write(FIXTURE.read_bytes())
+    prices = entsoe.fetch_prices()
+    assert entsoe.client.calls == 0
+    assert list(prices) == [10.5, 20.25, 30]
+    assert prices.index[0] == start
+    assert str(prices.index.tz) == 'Europe/Stockholm'
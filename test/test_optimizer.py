@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+from datetime import date
+from utils.optimizer import cost_optimizer, device, planner
+from utils.slots import calendar
+import numpy as np
+
+DAY = date(2026, 11, 2)
+SLOT = 900
+DT = SLOT / 3600
+
+
+def midnight(d: date = DAY):
+    return calendar().day(d).start
+
+
+def hourly(hours: int, cheap=(), low=1.0, high=10.0):
+    return [low if h in cheap else high for h in range(hours)]
+
+
+def on_between(schedule, start, first, last):
+    """Slots on from epoch first up to last"""
+    a = (first - start) // SLOT
+    b = (last - start) // SLOT
+    return int(schedule[a:b].sum())
+
+
+def test_site_cap():
+    devices = [device('a', energy=3, power=3), device('b', energy=3, power=3)]
+    p = planner(devices, site_cap=4, resolution=SLOT)
+    start = midnight()
+    prices, schedule = p.plan(start, 3600, hourly(24, cheap=(3,)), start, {})
+    load = sum(on * d.power for d, on in zip(devices, schedule.values()))
+    assert load.max() <= 4
+    for d in devices:
+        assert schedule[d.name].sum() * d.power * DT >= d.energy
+
+
+def test_energy_per_period():
+    # 2026-10-25 has 25 hours
+    for d in (DAY, date(2026, 10, 25)):
+        heater = device('heater', energy=3, power=1, min_run=30)
+        p = planner([heater], resolution=SLOT)
+        start = midnight(d)
+        hours = len(calendar().day(d)) + 24
+        _, schedule = p.plan(start, 3600, hourly(hours), start, {})
+        on = schedule['heater']
+        boundary = calendar().day(date.fromordinal(d.toordinal() + 1)).start
+        assert on_between(on, start, start, boundary) * DT == 3
+        assert on_between(on, start, boundary, boundary + 86400) * DT == 3
+
+
+def test_trailing_period_is_scaled():
+    # Demand periods start at noon, so the horizon ends half way into
+    # the last one, which only needs half of its energy yet.
+    heater = device('heater', energy=4, power=1, day_start=12)
+    p = planner([heater], resolution=SLOT)
+    start = midnight()
+    _, schedule = p.plan(start, 3600, hourly(48), start, {})
+    on = schedule['heater']
+    last = start + 36 * 3600
+    assert on_between(on, start, last, start + 48 * 3600) * DT == 2
+
+
+def test_midnight_carry_over():
+    conf = {'resolution': 15,
+            'devices': {'ev': {'energy': 14.8, 'power': 7.4,
+                               'windows': [[18, 7]], 'day_start': 12}}}
+    optimizer = cost_optimizer(conf)
+    start = midnight()
+    curve = {'start': start, 'step': 3600,
+             'values': hourly(48, cheap=(19, 20))}
+    optimizer.replan(curve, start + 13 * 3600)
+    ev = optimizer.schedule['ev']
+    assert on_between(ev, start, start + 19 * 3600, start + 21 * 3600) == 8
+    # After midnight the price curve starts today, the period that
+    # started yesterday noon has got its energy already.
+    today = start + 86400
+    curve = {'start': today, 'step': 3600,
+             'values': hourly(48, cheap=(0, 1))}
+    optimizer.replan(curve, today + 1800)
+    ev = optimizer.schedule['ev']
+    assert on_between(ev, today, today, today + 12 * 3600) == 0
+    assert len(optimizer.executed['ev']) == 8
+    assert np.any(ev[12 * 4:])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+from utils.outbox import outbox
+import json
+
+
+def make(tmp_path, **kw):
+    return outbox(tmp_path, batch_size=2, rate=1e6, **kw)
+
+
+class crash(Exception):
+    pass
+
+
+def test_crash_during_replay_keeps_queue(tmp_path):
+    box = make(tmp_path)
+    for i in range(5):
+        box.append(f'series/{i}', json.dumps({'v': i}), series=True)
+    sent = []
+
+    def dies_after_three(topic, payload, qos, retain):
+        if len(sent) == 3:
+            raise crash()
+        sent.append(topic)
+        return True
+    try:
+        box.replay(dies_after_three)
+    except crash:
+        pass
+    # A new process resumes after the last acknowledged batch
+    box = make(tmp_path)
+    box.append('series/new', json.dumps({'v': 9}), series=True)
+    resumed = []
+    assert box.replay(lambda t, p, q, r: resumed.append(t) or True)
+    assert resumed == ['series/2', 'series/3', 'series/4']
+    assert box.replay(lambda t, p, q, r: resumed.append(t) or True)
+    assert resumed[-1] == 'series/new'
+    assert not box.pending()
+
+
+def test_failed_send_keeps_rest(tmp_path):
+    box = make(tmp_path)
+    for i in range(3):
+        box.append('state', json.dumps({'v': i}))
+        box.append(f'series/{i}', json.dumps({'v': i}), series=True)
+    assert not box.replay(lambda t, p, q, r: t != 'series/1')
+    sent = []
+    assert box.replay(lambda t, p, q, r: sent.append(t) or True)
+    assert sent == ['series/1', 'state', 'series/2']
+
+
+def test_series_replayed_with_recorded_time(tmp_path):
+    box = make(tmp_path)
+    box.append('series', json.dumps({'v': 1}), series=True)
+    box.append('state', json.dumps({'v': 1}))
+    recorded = json.loads((tmp_path / '00000000.seg').read_text()
+                          .splitlines()[0])['ts']
+    sent = {}
+    box.replay(lambda t, p, q, r: sent.update({t: json.loads(p)}) or True)
+    assert sent['series'] == {'v': 1, 'ts': recorded}
+    assert sent['state'] == {'v': 1}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+from utils import resilience
+from utils.resilience import CircuitOpen, circuit_breaker
+from threading import local
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic time under test control, and no jitter"""
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(resilience.random, 'uniform', lambda a, b: b)
+    monkeypatch.setattr(resilience, 'breakers', {})
+    return now
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.failure()
+
+
+def test_single_probe_when_half_open(clock):
+    breaker = circuit_breaker('host', base_delay=10)
+    trip(breaker)
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == resilience.HALF_OPEN
+    # Only one probe until it has reported back
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == resilience.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_backs_off_up_to_max_delay(clock):
+    breaker = circuit_breaker('host', base_delay=10, max_delay=60)
+    trip(breaker)
+    delays = []
+    for _ in range(5):
+        delays.append(breaker.retry_in())
+        clock[0] += breaker.retry_in()
+        assert breaker.allow()
+        breaker.failure()
+    assert delays == [10, 20, 40, 60, 60]
+
+
+class response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_server_errors_count_client_errors_do_not(clock, monkeypatch):
+    status = [404]
+    monkeypatch.setattr(resilience.requests, 'get',
+                        lambda url, **kwargs: response(status[0]))
+    url = 'https://example.com/prices'
+    for _ in range(5):
+        assert resilience.get(url).status_code == 404
+    assert resilience.breaker(url).state == resilience.CLOSED
+    status[0] = 503
+    for _ in range(3):
+        assert resilience.get(url).status_code == 503
+    assert resilience.breaker(url).state == resilience.OPEN
+    with pytest.raises(CircuitOpen):
+        resilience.get(url)
+
+
+def test_budget_is_clamped(monkeypatch):
+    monkeypatch.setattr(resilience, 'budget', local())
+    assert resilience.timeout_budget() == resilience.default_timeout
+    resilience.set_budget(5)
+    assert resilience.timeout_budget() == resilience.min_timeout
+    resilience.set_budget(120)
+    assert resilience.timeout_budget() == 12
+    resilience.set_budget(3600)
+    assert resilience.timeout_budget() == resilience.max_timeout
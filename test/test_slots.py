@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+from datetime import date, datetime, timezone
+from utils.slots import calendar
+from utils.spot_price import PriceList, PriceStats, TZ
+import pandas as pd
+import pytest
+
+SPRING = date(2026, 3, 29)  # 23 hours
+AUTUMN = date(2026, 10, 25)  # 25 hours
+NORMAL = date(2026, 11, 2)
+
+
+def utc(text):
+    return datetime.fromisoformat(text).replace(tzinfo=timezone.utc) \
+        .timestamp()
+
+
+@pytest.mark.parametrize('day, hours', [(SPRING, 23), (AUTUMN, 25),
+                                        (NORMAL, 24)])
+@pytest.mark.parametrize('step', [3600, 900])
+def test_slots_per_day(day, hours, step):
+    d = calendar(step).day(day)
+    assert len(d) == hours * 3600 // step
+    assert d.end - d.start == hours * 3600
+    assert d.local[0].hour == 0
+    assert d.local[-1].hour == 23
+
+
+def test_autumn_repeated_hour():
+    d = calendar().day(AUTUMN)
+    assert d.hours[:5] == (0, 1, 2, 2, 3)
+    # 02:30 local happens twice, once in summer and once in winter time
+    first = d.index(utc('2026-10-25T00:30:00'))
+    second = d.index(utc('2026-10-25T01:30:00'))
+    assert (first, second) == (2, 3)
+    assert d.local[first].utcoffset() != d.local[second].utcoffset()
+
+
+def test_spring_skipped_hour():
+    d = calendar(900).day(SPRING)
+    assert 2 not in [int(h) for h in d.hours]
+    assert d.hours[8] == 3.0
+
+
+def test_locate_across_days():
+    cal = calendar(900)
+    day, slot = cal.locate(utc('2026-10-25T22:59:00'))
+    assert (day.date, slot) == (AUTUMN, 99)
+    day, slot = cal.locate(utc('2026-10-25T23:00:00'))
+    assert (day.date, slot) == (date(2026, 10, 26), 0)
+    located = cal.slots(cal.day(AUTUMN).start, 100 + 96)
+    assert [day.date for day, _ in located].count(AUTUMN) == 100
+
+
+class price_list(PriceList):
+
+    def __init__(self, prices, path):
+        super().__init__({'cache': path / 'prices.json',
+                          'history': path / 'history.json',
+                          'transfer_cost': [[6, 67], [22, 16]]}, None)
+        self.prices = prices
+
+
+def quarter_hours(day: date, days=1):
+    cal = calendar(900)
+    start = cal.day(day).start
+    end = cal.day(date.fromordinal(day.toordinal() + days)).start
+    index = pd.date_range(pd.Timestamp(start, unit='s', tz='UTC'),
+                          pd.Timestamp(end, unit='s', tz='UTC'),
+                          freq='15min', inclusive='left').tz_convert(TZ)
+    return pd.Series([float(i) for i in range(len(index))], index=index)
+
+
+def test_price_list_autumn_day(tmp_path):
+    prices = price_list(quarter_hours(AUTUMN, days=2), tmp_path)
+    assert [len(day) for day in prices.get_daily_prices()] == [100, 96]
+    for text, price in (('2026-10-25T00:30:00', 10.0),
+                        ('2026-10-25T01:30:00', 14.0)):
+        now = datetime.fromtimestamp(utc(text), TZ)
+        assert prices.instant_price(now) == price
+
+
+def test_ranking_beyond_24_slots(tmp_path):
+    today = datetime.now(TZ).date()
+    prices = price_list(quarter_hours(today), tmp_path)
+    now = datetime.now(TZ)
+    slot = calendar(900).locate(now.timestamp())[1]
+    # Raw prices increase through the day, so the rank is the slot
+    assert prices.current_ranking(with_tariff=False) == slot
+    assert price_list(quarter_hours(date.fromordinal(today.toordinal() + 2)),
+                      tmp_path).current_ranking() is None
+
+
+def test_history_keeps_30_days_up_to_today(tmp_path):
+    today = datetime.now(TZ).date()
+    stats = PriceStats(tmp_path / 'history.json')
+    summary = {'min': 1.0, 'max': 2.0, 'mean': 1.5}
+    # Tomorrow's complete day must not push out the oldest day
+    stats.history = {date.fromordinal(today.toordinal() + k).isoformat():
+                     summary for k in range(-40, 2)}
+    stats.save_history()
+    assert stats.rolling_windows()['30d']['days'] == 30
+    assert max(stats.history) > today.isoformat()
+    assert PriceStats(tmp_path / 'history.json').history == stats.history
+    assert not list(tmp_path.glob('*.tmp'))
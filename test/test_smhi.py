@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from utils import sensors
+from utils.sensors import smhi_bulk
+import pytest
+
+FIXTURE = Path(__file__).parent / 'fixtures' / 'smhi_latest_hour.json'
+WANTED = {'97100': 'tullinge',
+          '98230': 'stockholm',
+          '71420': 'goteborg',
+          '97200': 'bromma',  # value null
+          '97400': 'arlanda',  # value []
+          '98210': 'stockholm_old',  # sample value null
+          '98040': 'svanberga',  # no value key
+          '12345': 'unknown'}
+
+
+def parse(wanted):
+    with FIXTURE.open('rb') as fp:
+        return smhi_bulk.parse(fp, wanted)
+
+
+@pytest.fixture(params=[True, False], ids=['ijson', 'json'])
+def streaming(request, monkeypatch):
+    if request.param and not sensors.IJSON_OK:
+        pytest.skip('ijson not installed')
+    monkeypatch.setattr(sensors, 'IJSON_OK', request.param)
+
+
+def test_parse_fan_out(streaming):
+    assert parse(WANTED) == {'tullinge': 7.4,
+                             'stockholm': 8.1,
+                             'goteborg': 9.6}
+
+
+def test_parse_stops_when_all_found(streaming):
+    assert parse({'188790': 'abisko'}) == {'abisko': -2.3}
+
+
+def test_parse_nothing_wanted(streaming):
+    assert parse({}) == {}
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+from utils import snapshots
+from utils.snapshots import snapshot_store
+
+
+def test_save_and_load(tmp_path):
+    store = snapshot_store(tmp_path)
+    store.save('spotprice', {'price': 1.5}, {'png': b'\x89PNG', 'x': 1})
+    snap = store.load('spotprice')
+    assert snap['payload'] == {'price': 1.5}
+    assert snap['subtopics'] == {'x': 1}
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_series_writes_are_rate_limited(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(snapshots.time, 'monotonic', lambda: now[0])
+    store = snapshot_store(tmp_path, min_interval=600)
+    store.save('meter', {'power': 1}, {})
+    now[0] += 60
+    store.save('meter', {'power': 2}, {})
+    assert store.load('meter')['payload'] == {'power': 1}
+    now[0] += 600
+    store.save('meter', {'power': 3}, {})
+    assert store.load('meter')['payload'] == {'power': 3}
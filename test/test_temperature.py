@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from utils.temperature import temperature_sensors
+import time
+
+
+class flaky_sensors(temperature_sensors):
+    """Third read raises, like a w1 bus glitch"""
+
+    def __init__(self):
+        super().__init__({'sampling': {'period': 0.01}})
+        self.reads = 0
+
+    def get_temperatures(self):
+        self.reads += 1
+        if self.reads == 3:
+            raise OSError('w1 bus glitch')
+        return {'t': 20.0 + self.reads}
+
+
+def wait_for(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_sampler_survives_failed_read():
+    sensors = flaky_sensors()
+    try:
+        sensors.get_values()
+        assert wait_for(lambda: sensors.reads > 5)
+        assert sensors.sampler.is_alive()
+        assert sensors.get_values()['t'] > 23
+    finally:
+        sensors.stop()
+
+
+def test_dead_sampler_is_restarted():
+    sensors = flaky_sensors()
+    try:
+        sensors.get_values()
+        sensors.stop()
+        sensors.sampler.join(1)
+        sensors.stopped.clear()
+        sensors.get_values()
+        assert sensors.sampler.is_alive()
+    finally:
+        sensors.stop()
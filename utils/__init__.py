@@ -29,6 +29,7 @@ class config(dict):
         super().__init__(json.load(json_file))
         self.server = self['server']
         self.sources = self['sources']
+        self.cluster = self.get('cluster')
 
     @classmethod
     def inv(cls, d):
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+from . import log
+from .bus import BUS
+from .encoding import encode_json
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+import gzip
+import hashlib
+
+
+class response_cache:
+    """Small LRU of encoded responses, keyed on request and the bus
+    versions they were built from, so repeated requests cost a lookup"""
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+def timestamp(value: str):
+    """Epoch seconds from epoch or ISO time in a query parameter"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class state_api:
+    """
+    Read only HTTP/JSON view of the in-memory state, i.e. the bus, so
+    scripts and dashboards need neither MQTT nor upstream calls:
+
+    /sources               latest payload of every source
+    /sources/<name>        latest payload of one source
+    /bus/<key>             any bus value, e.g. /bus/optimizer/plan
+    /prices                price curve, optionally ?from=&to= (epoch
+                           or ISO time) to select a range of slots
+    /prices/now            current price payload
+    /prices/stats          price statistics
+
+    Responses are encoded once per bus version and served from memory,
+    carry an ETag and honour If-None-Match with 304, and are gzipped
+    when accepted. Configured at
+    top level as "api": {"address": ..., "port": ..., "prices": name}.
+    """
+    min_gzip = 512
+
+    def __init__(self, conf: dict):
+        self.address = conf.get('address', '127.0.0.1')
+        self.port = conf.get('port', 8080)
+        self.prices = conf.get('prices', 'spotprice')
+        self.cache = response_cache()
+
+    def source_keys(self):
+        return sorted(k for k in BUS.items()
+                      if '/' not in k and not k.startswith('_'))
+
+    def route(self, path: str, query: dict):
+        """(bus keys used, function building the body) for a path"""
+        parts = [p for p in path.split('/') if p]
+        if parts == ['sources']:
+            keys = self.source_keys()
+            return keys, lambda: {k: BUS.value(k) for k in keys}
+        if len(parts) == 2 and parts[0] == 'sources':
+            return [parts[1]], lambda: BUS.value(parts[1])
+        if len(parts) > 1 and parts[0] == 'bus':
+            key = '/'.join(parts[1:])
+            return [key], lambda: BUS.value(key)
+        if parts == ['prices']:
+            key = f'{self.prices}/curve'
+            return [key], lambda: self.curve_range(BUS.value(key), query)
+        if parts == ['prices', 'now']:
+            return [self.prices], lambda: BUS.value(self.prices)
+        if parts == ['prices', 'stats']:
+            return [self.prices], \
+                lambda: (BUS.value(self.prices) or {}).get('stats')
+        return None, None
+
+    @staticmethod
+    def curve_range(curve, query: dict):
+        if not curve or not ('from' in query or 'to' in query):
+            return curve
+        start, step = curve['start'], curve['step']
+        values = curve['values']
+        first = 0
+        last = len(values)
+        if 'from' in query:
+            first = max(int((timestamp(query['from'][0]) - start) // step), 0)
+        if 'to' in query:
+            last = min(int(-(-(timestamp(query['to'][0]) - start) // step)),
+                       last)
+        result = dict(curve)
+        result['start'] = start + first * step
+        result['values'] = values[first:max(last, first)]
+        return result
+
+    def build(self, key, build):
+        """Encoded response for the bus versions in key, built once.
+        The ETag hashes the body, so it also stays valid across restarts
+        and for the same content under other keys or query strings."""
+        if (cached := self.cache.get(key)) is not None:
+            return cached
+        value = build()
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray)):
+            body = bytes(value)
+            content_type = 'image/png' if body[:4] == b'\x89PNG' \
+                else 'image/svg+xml'
+        else:
+            body = encode_json(value).encode()
+            content_type = 'application/json'
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        compressed = gzip.compress(body, compresslevel=5) \
+            if len(body) >= self.min_gzip else None
+        cached = (etag, content_type, body, compressed)
+        self.cache.put(key, cached)
+        return cached
+
+    def respond(self, path: str, query: dict, headers):
+        """(status, headers, body) for a GET request"""
+        keys, build = self.route(path, query)
+        if keys is None:
+            return 404, {}, b''
+        versions = tuple((s.version if (s := BUS.get(k)) else 0)
+                         for k in keys)
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in query.items())),
+               versions)
+        if (cached := self.build(key, build)) is None:
+            return 404, {}, b''
+        etag, content_type, body, compressed = cached
+        out = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in headers.get('If-None-Match', ''):
+            return 304, out, b''
+        out['Content-Type'] = content_type
+        if compressed and 'gzip' in headers.get('Accept-Encoding', ''):
+            out['Content-Encoding'] = 'gzip'
+            out['Vary'] = 'Accept-Encoding'
+            body = compressed
+        return 200, out, body
+
+    def handler(self):
+        api = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes on a kept alive socket
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    status, headers, body = \
+                        api.respond(url.path, parse_qs(url.query),
+                                    self.headers)
+                except (ValueError, TypeError) as e:
+                    status, headers, body = 400, {}, str(e).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return handler
+
+    def start(self):
+        try:
+            server = ThreadingHTTPServer((self.address, self.port),
+                                         self.handler())
+        except OSError as e:
+            log(f'state_api can not listen on {self.address}:{self.port}. '
+                f'{e}')
+            return None
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True,
+               name='state_api').start()
+        log(f'state_api serving on {self.address}:{self.port}')
+        return server
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+from threading import Condition
+from types import MappingProxyType
+import time
+
+
+@dataclass(frozen=True)
+class snapshot:
+    key: str
+    version: int
+    value: object
+    time: float
+
+
+def freeze(value):
+    """Immutable copy, so a snapshot can be shared between threads
+    without locking: dicts become read only mappings, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def bus_keys(conf: dict):
+    """Keys a sensor reads from the bus, "bus": "name" or [names]"""
+    keys = conf.get('bus') or []
+    return [keys] if isinstance(keys, str) else list(keys)
+
+
+class data_bus:
+    """
+    In-process publish/subscribe between sources in the same daemon.
+    Each key holds the latest immutable snapshot, versioned by a bus
+    wide counter, and waiting consumers are woken when a key changes.
+    Publishing an unchanged value keeps the snapshot and wakes no one.
+    Sources publish their results under their source name, and sub
+    topic payloads under name/suffix. MQTT is for external consumers.
+    """
+
+    def __init__(self):
+        self.changed = Condition()
+        self.version = 0
+        self.values: dict = {}
+
+    @staticmethod
+    def same(a, b):
+        try:
+            return bool(a == b)
+        except (ValueError, TypeError):
+            # e.g. numpy arrays, compare as changed
+            return False
+
+    def publish(self, key: str, value):
+        frozen = freeze(value)
+        with self.changed:
+            old = self.values.get(key)
+            if old is not None and type(old.value) is type(frozen) and \
+                    self.same(old.value, frozen):
+                return old
+            self.version += 1
+            snap = snapshot(key, self.version, frozen, time.time())
+            self.values[key] = snap
+            self.changed.notify_all()
+        return snap
+
+    def get(self, key: str) -> snapshot:
+        return self.values.get(key)
+
+    def value(self, key: str, default=None):
+        snap = self.values.get(key)
+        return default if snap is None else snap.value
+
+    def latest(self, keys):
+        """Highest version among keys, 0 if none published yet"""
+        return max((s.version for k in keys
+                    if (s := self.values.get(k))), default=0)
+
+    def wait(self, keys, version: int, timeout: float = None):
+        """Block until one of keys is newer than version, or timeout.
+        Returns True if something changed."""
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: self.latest(keys) > version, timeout)
+
+    def items(self):
+        return dict(self.values)
+
+
+BUS = data_bus()
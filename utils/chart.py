@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+from . import log
+from .sensors import general_sensors
+from .bus import BUS
+from .slots import calendar
+from datetime import datetime
+from dateutil import tz
+from io import BytesIO
+from pathlib import Path
+import importlib.util
+import time
+
+TZ = tz.gettz('Europe/Stockholm')
+
+
+class price_chart(general_sensors):
+    """
+    Renders the tariff inclusive price curve, a now line and optionally
+    an on/off schedule to png or svg, headless. The figure is built
+    once and only its data is updated, and it is only re-rendered when
+    the curve, the schedule or the current slot changed. The image is
+    published retained on <topic>/<format> when it changed, so that
+    dashboards connecting later get it at once, and written to
+    "output" if configured, for dashboards to fetch.
+    Configure "curve": "spotprice/curve" and "schedule":
+    "optimizer/plan", which are bus keys of the sources producing them.
+    """
+    # matplotlib takes seconds to import on a Pi, only pay for it in
+    # setup() when a chart is configured
+    ok = importlib.util.find_spec('matplotlib') is not None
+
+    def __init__(self, conf: dict):
+        super().__init__(conf)
+        self.configure(conf)
+
+    def configure(self, conf: dict):
+        self.curve_key = conf.get('curve', 'spotprice/curve')
+        self.schedule_key = conf.get('schedule')
+        self.format = conf.get('format', 'png')
+        self.retain_subtopics = (self.format,)
+        self.output = Path(conf['output']) if conf.get('output') else None
+        self.size = conf.get('size', [8, 4])
+        self.dpi = conf.get('dpi', 100)
+        self.figure = None
+        self.render_key = None
+        self.image: bytes = None
+        self.rendered = None
+        self.changed = False
+
+    def reconfigure(self, conf: dict):
+        self.conf = conf
+        self.configure(conf)
+        return True
+
+    def setup(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.figure import Figure
+        import matplotlib.dates as mdates
+        self.figure = Figure(figsize=self.size, dpi=self.dpi, layout='tight')
+        self.ax = self.figure.add_subplot()
+        self.price_line, = self.ax.plot([], [], drawstyle='steps-post',
+                                        color='green', linewidth=2)
+        self.now_line = self.ax.axvline(datetime.now(TZ), color='red',
+                                        linewidth=1)
+        self.schedule_bands = []
+        self.ax.grid(True)
+        self.ax.xaxis.set_major_formatter(
+            mdates.DateFormatter('%H', tz=TZ))
+
+    @staticmethod
+    def times(start, step, count):
+        return [day.local[i]
+                for day, i in calendar(step).slots(start, count)]
+
+    def draw_schedule(self, plan, top):
+        for band in self.schedule_bands:
+            band.remove()
+        self.schedule_bands = []
+        if not plan:
+            return
+        devices = plan.get('devices', {})
+        height = 0.08 * top
+        for k, (name, on) in enumerate(devices.items()):
+            x = self.times(plan['start'], plan['step'], len(on) + 1)
+            y0 = -height * (k + 1)
+            band = self.ax.fill_between(x[:-1], y0, y0 + 0.8 * height,
+                                        where=[bool(v) for v in on],
+                                        step='post', alpha=0.6,
+                                        label=name)
+            self.schedule_bands.append(band)
+
+    def render(self, curve, plan, now):
+        if self.figure is None:
+            self.setup()
+        values = list(curve['values'])
+        x = self.times(curve['start'], curve['step'], len(values) + 1)
+        self.price_line.set_data(x, values + values[-1:])
+        self.now_line.set_xdata([now, now])
+        top = max(values)
+        self.draw_schedule(plan, top)
+        self.ax.set_xlim(x[0], x[-1])
+        self.ax.relim()
+        self.ax.autoscale_view(scalex=False)
+        self.ax.set_title(f'Price {curve.get("unit", "")} '
+                          f'{now.strftime("%Y-%m-%d %H:%M")}')
+        buffer = BytesIO()
+        self.figure.savefig(buffer, format=self.format)
+        self.image = buffer.getvalue()
+        self.rendered = now.isoformat()
+        if self.output:
+            tmp = self.output.with_suffix('.tmp')
+            tmp.write_bytes(self.image)
+            tmp.replace(self.output)
+
+    def get_values(self):
+        curve_snap = BUS.get(self.curve_key)
+        if curve_snap is None or not curve_snap.value.get('values'):
+            log(f'price_chart has no curve on {self.curve_key}')
+            return {}
+        plan_snap = BUS.get(self.schedule_key) if self.schedule_key else None
+        curve = curve_snap.value
+        plan = plan_snap.value if plan_snap else None
+        # The current slot matters too, so compare content, not versions
+        slot = int(time.time() // curve['step'])
+        key = (curve['start'], curve['values'], slot,
+               plan and tuple(plan.get('devices', {}).items()))
+        self.changed = key != self.render_key
+        if self.changed:
+            t0 = time.perf_counter()
+            self.render(curve, plan, datetime.now(TZ))
+            self.render_key = key
+            log(f'price_chart rendered {len(self.image)} bytes in '
+                f'{1000 * (time.perf_counter() - t0):.0f} ms')
+        return {'format': self.format,
+                'bytes': len(self.image),
+                'rendered': self.rendered}
+
+    def subtopics(self):
+        if self.changed and self.image:
+            return {self.format: self.image}
+        return {}
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+from . import log
+import json
+import os
+import socket
+import time
+
+
+def node_name(conf: dict):
+    return conf.get('node') or os.getenv('SPOTPRICES_NODE') \
+        or socket.gethostname()
+
+
+class lease:
+    """
+    Ownership of one shared source among several daemons, coordinated
+    over a retained topic holding {"node": name, "expires": epoch}.
+    The broker keeps the last claim, so all nodes agree on the holder:
+    a node owns the source only once its own claim has come back from
+    the broker. The holder renews every third of the period, and when
+    it dies, another node claims the source after expiry, i.e. within
+    one lease period. Expiry is wall clock time, so nodes need NTP.
+
+    Nothing here talks to the network, the client feeds received lease
+    messages to on_message() and publishes what claim() returns.
+    """
+
+    def __init__(self, source: str, node: str, period: float = 60,
+                 prefix: str = 'spotprices/cluster'):
+        self.source = source
+        self.node = node
+        self.period = period
+        self.topic = f'{prefix}/lease/{source}'
+        self.holder = None
+        self.expires = 0
+
+    def on_message(self, payload):
+        """Returns True if ownership of this node changed"""
+        was_owner = self.owned()
+        try:
+            data = json.loads(payload) if payload else {}
+            self.holder = data.get('node')
+            self.expires = float(data.get('expires', 0))
+        except (ValueError, TypeError, AttributeError):
+            log(f'lease {self.topic} got unparseable {payload}')
+            return False
+        return was_owner != self.owned()
+
+    def owned(self, now: float = None):
+        now = now or time.time()
+        return self.holder == self.node and self.expires > now
+
+    def claim(self, now: float = None):
+        """Payload to publish, or None when there is nothing to do:
+        another node holds a valid lease, or ours is fresh enough."""
+        now = now or time.time()
+        if self.holder and self.holder != self.node and self.expires > now:
+            return None
+        if self.owned(now) and self.expires - now > self.period * 2 / 3:
+            return None
+        return json.dumps({'node': self.node, 'expires': now + self.period})
+
+    def wait(self, now: float = None):
+        """Seconds until the next claim() is due. Nodes not holding the
+        lease wake up when it expires, so a dead holder is replaced
+        within one lease period of its last renewal."""
+        now = now or time.time()
+        wait = self.period / 6
+        if self.holder and self.holder != self.node and self.expires > now:
+            wait = min(wait, self.expires - now)
+        return wait
+
+    def release(self):
+        """Empty retained payload, which clears the lease on the broker"""
+        if self.owned():
+            self.holder = None
+            return b''
+        return None
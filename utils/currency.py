@@ -9,6 +9,7 @@ import os
 class currency_sensor(general_sensors):
     cache_timeout_s = 12 * 3600
     ok = False
+    shared = True
 
     def __init__(self, conf: dict):
         super().__init__(conf)
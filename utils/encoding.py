@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+from . import log
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+import json
+import time
+
+try:
+    import orjson
+    ORJSON_OK = True
+except Exception:
+    ORJSON_OK = False
+
+try:
+    import msgpack
+    MSGPACK_OK = True
+except Exception:
+    MSGPACK_OK = False
+
+try:
+    import cbor2
+    CBOR_OK = True
+except Exception:
+    CBOR_OK = False
+
+
+def _default(obj):
+    """Fallback for numpy scalars and timestamps found in sensor results,
+    and read only mappings from the bus"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if hasattr(obj, 'item'):
+        return obj.item()
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f'Can not encode {type(obj)}')
+
+
+def encode_json(data):
+    return json.dumps(data, default=_default)
+
+
+def encode_fast_json(data):
+    if ORJSON_OK:
+        return orjson.dumps(data, default=_default,
+                            option=orjson.OPT_NON_STR_KEYS
+                            | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=_default, separators=(',', ':'))
+
+
+def encode_msgpack(data):
+    return msgpack.packb(data, default=_default)
+
+
+def encode_cbor(data):
+    return cbor2.dumps(data, default=lambda enc, obj: enc.encode(
+        _default(obj)))
+
+
+ENCODERS = {'json': (encode_json, True),
+            'fast_json': (encode_fast_json, True),
+            'msgpack': (encode_msgpack, MSGPACK_OK),
+            'cbor': (encode_cbor, CBOR_OK)}
+
+
+DECODERS = {'json': (json.loads, True),
+            'fast_json': (orjson.loads if ORJSON_OK else json.loads, True),
+            'msgpack': (msgpack.unpackb if MSGPACK_OK else None, MSGPACK_OK),
+            'cbor': (cbor2.loads if CBOR_OK else None, CBOR_OK)}
+
+
+def get_encoder(name: str = None):
+    """Return an encoder function by config name. JSON is the default,
+    since that is what Home Assistant expects. Binary encodings are
+    optional and fall back to json if the module is missing."""
+    encoder, available = ENCODERS.get(name or 'json', (None, False))
+    if encoder is None:
+        log(f'Unknown payload encoding {name}, using json')
+        return encode_json
+    if not available:
+        log(f'Payload encoding {name} not installed, using json')
+        return encode_json
+    return encoder
+
+
+def encode(encoder, payload):
+    """str and bytes payloads, e.g. availability, are sent unchanged"""
+    if isinstance(payload, (str, bytes, bytearray)):
+        return payload
+    return encoder(payload)
+
+
+def decode(name: str, payload):
+    """Inverse of encode for an encoding config name, falling back to
+    json like get_encoder. Payloads that do not decode, e.g. images,
+    are returned unchanged."""
+    decoder, available = DECODERS.get(name or 'json', (None, False))
+    if not available:
+        decoder = json.loads
+    try:
+        return decoder(payload)
+    except Exception:
+        return payload
+
+
+def price_curve(series, decimals=3):
+    """Compact array form of a price series, e.g. a 48 h horizon:
+    {"start": epoch seconds, "step": seconds, "values": [...]}
+    Assumes equidistant slots, which holds for day-ahead price lists."""
+    if series is None or len(series) == 0:
+        return {}
+    index = series.index
+    start = int(index[0].timestamp())
+    if len(index) > 1:
+        step = int((index[1] - index[0]).total_seconds())
+    else:
+        step = 3600
+    return {'start': start,
+            'step': step,
+            'values': [round(float(v), decimals) for v in series.values]}
+
+
+@dataclass
+class publish_stats:
+    messages: int = 0
+    bytes: int = 0
+    since: float = field(default_factory=time.monotonic)
+
+    def add(self, payload):
+        self.messages += 1
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if payload is not None:
+            self.bytes += len(payload)
+
+    def report(self, reset=True):
+        elapsed = max(time.monotonic() - self.since, 1e-6)
+        result = {'messages': self.messages,
+                  'bytes': self.bytes,
+                  'messages_per_s': round(self.messages / elapsed, 3),
+                  'bytes_per_s': round(self.bytes / elapsed, 1)}
+        if reset:
+            self.messages = 0
+            self.bytes = 0
+            self.since = time.monotonic()
+        return result
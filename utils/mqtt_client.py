@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
 from . import log, config
-from .temperature import http_sensors, w1_sensors
+from .temperature import http_sensors, w1_sensors, smhi_sensors
 from .currency import currency_sensor
-from .spot_price import entsoe_price_list, elprisetjustnu_price_list
+from .optimizer import cost_optimizer
+from .chart import price_chart
+from .spot_price import entsoe_price_list, elprisetjustnu_price_list, \
+    hedged_price_list
+from .encoding import get_encoder, encode, decode, encode_json, \
+    publish_stats
+from .outbox import outbox
+from . import resilience
+from .bus import BUS, bus_keys
+from .cluster import lease, node_name
+from .snapshots import snapshot_store, since_start
 import paho.mqtt.client as mqtt
+from concurrent import futures
 from dataclasses import dataclass
-import sys
+from threading import Thread, Lock, Event
 import time
 import json
 
@@ -23,6 +34,9 @@ class hass_topic:
     topic: str = '$SYS/#'
     retain: bool = False
     qos: int = 0
+    # Time-series points are all kept by the outbox, other messages
+    # are coalesced to the latest state per topic.
+    series: bool = False
 
     def __repr__(self):
         return f'{self.topic}, retain = {self.retain}, QoS = {self.qos}'
@@ -30,6 +44,8 @@ class hass_topic:
 
 class hass_client(mqtt.Client):
     debug = False
+    min_reconnect_delay = 1
+    max_reconnect_delay = 300
 
     def __init__(self):
         super().__init__()
@@ -38,38 +54,117 @@ class hass_client(mqtt.Client):
                              'available': hass_topic(topic='$SYS/available'),
                              'pub': None}
         self.QoS: int = 1
-        self.shared_data: dict = {}
         self.subscription_topic = None
+        self.encoding = None
+        self.encoder = get_encoder()
+        self.stats = publish_stats()
+        # Publishes within one scheduling tick are collected here
+        # between begin_batch() and flush().
+        self.batch: list = None
+        self.batch_topic: hass_topic = None
+        self.connected = False
+        self.online = Event()
+        self.outbox: outbox = None
+        self.replaying = False
+        self.replay_lock = Lock()
 
     def connect(self):
-        try:
-            super().connect(self.server.address, self.server.port,
-                            keepalive=60)
-        except Exception:
-            log('Can not connect to mqtt server.')
-            sys.exit(1)
-        self.pub('available', 'online')
+        """The connection is made by the network loop thread, which
+        retries with exponential backoff, so an unreachable broker does
+        not stop the daemon. Publishes meanwhile go to the outbox."""
+        self.reconnect_delay_set(min_delay=self.min_reconnect_delay,
+                                 max_delay=self.max_reconnect_delay)
+        self.connect_async(self.server.address, self.server.port,
+                           keepalive=60)
 
     def on_connect(self, client, userdata, flags, rc):
         log(f'Connected. Result code {str(rc)}')
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            self.connected = True
+            self.online.set()
+            self.sub()
+            self.start_replay()
+            self.pub('available', 'online')
 
     def on_disconnect(self, client, userdata, rc):
         log(f'Disconnecting. Result code {str(rc)}')
+        self.connected = False
+        self.online.clear()
 
     def on_message(self, client, userdata, msg):
+        """Subscribed data goes to the bus, keyed by topic, so that the
+        sensor thread reads it as an immutable snapshot"""
         try:
-            log(f'XXX Client waiting for payload')
-            self.shared_data = json.loads(msg.payload)
-            log(f'Client received {self.shared_data}')
+            data = BUS.publish(msg.topic, json.loads(msg.payload)).value
+            log(f'Client received {data}')
         except (ValueError, TypeError):
             log(f'Got unparseable message on {msg.topic} - {msg.payload}')
 
     def pub(self, topic_name, payload):
-        topic = self.topics[topic_name]
-        self.publish(topic.topic,
-                     payload=payload,
-                     qos=topic.qos,
-                     retain=topic.retain)
+        self.publish_topic(self.topics[topic_name], payload)
+
+    def publish_topic(self, topic: hass_topic, payload):
+        if self.batch is not None:
+            self.batch.append((topic, payload))
+        else:
+            self.send(topic, encode(self.encoder, payload))
+
+    def send(self, topic: hass_topic, payload):
+        with self.replay_lock:
+            # While replaying, new messages queue up behind the old ones
+            # so that a stale state never overwrites a newer one.
+            if not self.replaying and \
+                    self.resend(topic.topic, payload, topic.qos, topic.retain):
+                return
+            if self.outbox:
+                self.outbox.append(topic.topic, payload, topic.qos,
+                                   topic.retain, topic.series)
+
+    def resend(self, topic: str, payload, qos: int, retain: bool):
+        if not self.connected:
+            return False
+        info = self.publish(topic, payload=payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        self.stats.add(payload)
+        return True
+
+    def replay_send(self, topic: str, payload, qos: int, retain: bool):
+        return self.resend(topic, payload, qos, retain)
+
+    def start_replay(self):
+        with self.replay_lock:
+            if self.replaying or not (self.outbox and self.outbox.pending()):
+                return
+            self.replaying = True
+        Thread(target=self.replay, daemon=True, name='outbox_replay').start()
+
+    def replay(self):
+        done = False
+        while not done:
+            ok = self.outbox.replay(self.replay_send)
+            with self.replay_lock:
+                if not ok or not self.outbox.pending():
+                    self.replaying = False
+                    done = True
+
+    def begin_batch(self):
+        self.batch = []
+
+    def flush(self):
+        """Publish everything collected since begin_batch(). If a
+        batch_topic is configured, all data payloads of the tick go out
+        as one message {topic: payload, ...}, for consumers that prefer
+        few large messages. Availability is always sent on its own."""
+        batch, self.batch = self.batch or [], None
+        if self.batch_topic:
+            available = self.topics['available']
+            combined = {t.topic: p for t, p in batch if t is not available}
+            batch = [(t, p) for t, p in batch if t is available]
+            if combined:
+                batch.append((self.batch_topic, combined))
+        for topic, payload in batch:
+            self.send(topic, encode(self.encoder, payload))
 
     def sub(self):
         """In order to communicate data btw threads, self can subscribe
@@ -96,40 +191,105 @@ class mqtt_publisher(hass_client):
         super().__init__()
         self.server = server_info(**conf.server)
         self.conf = conf
+        self.bus_keys: list = []
+        self.bus_version = 0
+        self.startup: dict = {}
+        self.stopping = False
 
     def read(self, name: str):
+        self.name = name
         conf = self.conf.sources[name]
         self.type_name = conf['type']
         self.disabled = conf.get('disable')
         self.type_conf = conf[self.type_name]
-        self.topics['pub'] = hass_topic(topic=conf['topic'])
+        self.topics['pub'] = hass_topic(topic=conf['topic'],
+                                        series=conf.get('series', False))
         self.topics['available'] = hass_topic(topic=conf['available'])
         self.execution_delay = \
             conf.get('update_period') or self.exception_delay
         self.exception_delay = \
             conf.get('retry_period') or self.execution_delay
+        self.encoding = conf.get('encoding')
+        self.encoder = get_encoder(self.encoding)
+        if batch_topic := conf.get('batch_topic'):
+            self.batch_topic = hass_topic(topic=batch_topic)
+        if metrics := conf.get('metrics'):
+            self.topics['metrics'] = hass_topic(topic=metrics)
+        outbox_conf = conf.get('outbox', {})
+        if outbox_conf is not False:
+            self.outbox = outbox(outbox_conf.get('path', f'db/outbox/{name}'),
+                                 batch_size=outbox_conf.get('batch_size', 50),
+                                 rate=outbox_conf.get('rate', 20),
+                                 encoding=self.encoding)
+
+    def subtopic(self, suffix: str, retain: bool = None):
+        pub = self.topics['pub']
+        return hass_topic(topic=f'{pub.topic}/{suffix}',
+                          retain=pub.retain if retain is None else retain,
+                          qos=pub.qos)
+
+    def phase(self, name: str):
+        """Record seconds from process start to a startup phase"""
+        if name not in self.startup:
+            self.startup[name] = since_start()
+            log(f'{self.name} startup phase {name} at {self.startup[name]} s')
+
+    def report_metrics(self):
+        if self.topics.get('metrics'):
+            metrics = self.stats.report()
+            metrics['breakers'] = resilience.report()
+            if not self.startup.get('reported'):
+                metrics['startup'] = dict(self.startup)
+                self.startup['reported'] = True
+            self.pub('metrics', metrics)
 
     def action(self):
         return False
 
+    def warm_start(self):
+        pass
+
+    def wait_keys(self):
+        return self.bus_keys + [f'_wake/{self.name}']
+
+    def wake(self):
+        """Cut the current idle() short and run action() again"""
+        BUS.publish(f'_wake/{self.name}', time.time())
+
+    def idle(self, delay):
+        """Sleep until the next update, or until woken, or until a
+        source this one depends on has published something new"""
+        BUS.wait(self.wait_keys(), self.bus_version, delay)
+
     def run(self):
+        resilience.set_budget(self.execution_delay)
         self.connect()
         self.loop_start()
-        self.sub()
-        while True:
+        self.warm_start()
+        while not self.stopping:
             try:
-                if self.action():
-                    time.sleep(self.execution_delay)
+                self.bus_version = BUS.latest(self.wait_keys())
+                success = self.action()
+                self.report_metrics()
+                if self.stopping:
+                    break
+                if success:
+                    self.idle(self.execution_delay)
                 else:
                     log('mqtt_publisher.action returned nothing')
                     self.offline()
-                    time.sleep(self.exception_delay)
+                    self.idle(self.exception_delay)
             except (KeyboardInterrupt, SystemExit):
                 self.offline()
                 break
         self.loop_stop()
         self.disconnect()
 
+    def stop(self):
+        """Make run() return after the current action"""
+        self.stopping = True
+        self.wake()
+
     def offline(self):
         self.pub('available', 'offline')
 
@@ -141,6 +301,8 @@ class mqtt_sensor(mqtt_publisher):
     It instantiates a sensor, e.g. http_sensor, w1_sensor, entsoe...
     at runtime, from string name, so must have access to those classes.
     """
+    warm_start_timeout = 1
+    reconfigure_timeout = 30
 
     def __init__(self, conf: config, name: str):
         super().__init__(conf)
@@ -149,18 +311,234 @@ class mqtt_sensor(mqtt_publisher):
         # Runtime sensor selection
         sensor_class = globals()[self.type_name]
         self.sensor = sensor_class(self.type_conf)
+        self.sensor.wake = self.wake
 
-        # Need to be able to share client subcription data with sensor
-        # So, sensor can be configured with a "subscription": "topic"
-        # to which this client then subscribes. In action() below,
-        # self shares the received data with the sensor.
+        # Sensors can depend on data from other sources. In the same
+        # process that is read from the bus, configured as "bus": name.
+        # From outside, the sensor can be configured with
+        # "subscription": "topic" to which this client then subscribes,
+        # and received data also ends up on the bus, keyed by topic.
+        # In action() below, self shares the data with the sensor.
         self.subscription_topic = self.sensor.subscription_topic
+        self.bus_keys = bus_keys(self.type_conf)
+        if self.subscription_topic:
+            self.bus_keys.append(self.subscription_topic)
+
+        # In cluster mode, shared sources (prices, currency...) are
+        # updated only by the node holding the lease of the source.
+        self.lease = None
+        cluster = conf.cluster
+        shared = conf.sources[name].get('shared',
+                                        getattr(self.sensor, 'shared', False))
+        if cluster and shared:
+            self.lease = lease(name, node_name(cluster),
+                               period=cluster.get('lease_period', 60),
+                               prefix=cluster.get('prefix',
+                                                  'spotprices/cluster'))
+
+        # (config, future) handed from the supervisor to the sensor thread
+        self.reconfigure_request = None
+        self.snapshots = None
+        if conf.get('warm_start', True):
+            # Time-series payloads change on every update
+            period = 600 if self.topics['pub'].series else 0
+            self.snapshots = snapshot_store(
+                conf.get('snapshots', 'db/snapshots'),
+                min_interval=conf.sources[name].get('snapshot_period',
+                                                    period))
+        self.phase('constructed')
 
     def sensor_ok(self):
         return self.sensor.ok
 
+    def stop(self):
+        if stop_sensor := getattr(self.sensor, 'stop', None):
+            stop_sensor()
+        super().stop()
+
+    def reconfigure(self, conf: config):
+        """Apply a changed config in place when only the sensor section
+        changed and the sensor can take it without restarting. Returns
+        False when the source has to be restarted.
+        The sensor is only ever changed by its own thread, at the start
+        of the next action(), so never in the middle of an update. This
+        waits for that, and gives up on a sensor busy for too long."""
+        old = self.conf.sources[self.name]
+        new = conf.sources[self.name]
+        if old.get('type') != new.get('type') or \
+                conf.server != self.conf.server or \
+                conf.cluster != self.conf.cluster:
+            return False
+        if {k: v for k, v in old.items() if k != self.type_name} != \
+                {k: v for k, v in new.items() if k != self.type_name}:
+            return False
+        request = futures.Future()
+        self.reconfigure_request = (conf, request)
+        self.wake()
+        try:
+            return request.result(self.reconfigure_timeout)
+        except futures.TimeoutError:
+            if request.cancel():
+                log(f'{self.name} busy, restarting it to reconfigure')
+                return False
+            return request.result()
+
+    def apply_reconfigure(self):
+        """Take a config queued by reconfigure(), in the sensor thread"""
+        if not (pending := self.reconfigure_request):
+            return
+        self.reconfigure_request = None
+        conf, request = pending
+        if not request.set_running_or_notify_cancel():
+            return
+        new = conf.sources[self.name]
+        try:
+            ok = bool(self.sensor.reconfigure(new[self.type_name]))
+        except Exception as e:
+            log(f'{self.name} reconfigure failed: {e}')
+            ok = False
+        if ok:
+            self.conf = conf
+            self.type_conf = new[self.type_name]
+        request.set_result(ok)
+
+    def warm_start(self):
+        """Publish the last known values, marked stale, as soon as the
+        broker is connected, before the first upstream fetch. Not for
+        leased sources, where another node may have fresher data."""
+        if self.lease or not self.snapshots:
+            return
+        if not (snap := self.snapshots.load(self.name)):
+            return
+        if self.online.wait(self.warm_start_timeout):
+            self.phase('connected')
+
+        def stale(payload):
+            return dict(payload, stale=True) \
+                if isinstance(payload, dict) else payload
+        self.begin_batch()
+        self.pub('available', 'online')
+        self.pub('pub', stale(snap['payload']))
+        BUS.publish(self.name, stale(snap['payload']))
+        for suffix, payload in snap.get('subtopics', {}).items():
+            self.publish_topic(self.sensor_topic(suffix), stale(payload))
+            BUS.publish(f'{self.name}/{suffix}', stale(payload))
+        self.flush()
+        self.phase('stale_publish')
+
+    def sub(self):
+        super().sub()
+        if self.lease:
+            self.subscribe(self.lease.topic, qos=1)
+            # The holder's payloads, see mirror(). pub/# includes pub.
+            self.subscribe(f'{self.topics["pub"].topic}/#', qos=1)
+            if self.batch_topic:
+                self.subscribe(self.batch_topic.topic, qos=1)
+
+    def on_message(self, client, userdata, msg):
+        if self.lease and msg.topic == self.lease.topic:
+            if self.lease.on_message(msg.payload):
+                self.wake()
+        elif not (self.lease and self.mirror(msg.topic, msg.payload)):
+            super().on_message(client, userdata, msg)
+
+    def mirror(self, topic: str, payload):
+        """On nodes not holding the lease, copy what the holder publishes
+        for this source to the bus, under the source name and name/suffix
+        like action() does, so that dependent sources and local consumers
+        see the same data on every node. Returns False for other topics."""
+        pub = self.topics['pub'].topic
+        if self.batch_topic and topic == self.batch_topic.topic:
+            messages = decode(self.encoding, payload)
+            if not isinstance(messages, dict):
+                return True
+        elif topic == pub or topic.startswith(f'{pub}/'):
+            messages = {topic: decode(self.encoding, payload)}
+        else:
+            return False
+        if self.lease.owned():
+            # Our own messages coming back
+            return True
+        for t, value in messages.items():
+            if t == pub:
+                BUS.publish(self.name, value)
+            elif t.startswith(f'{pub}/'):
+                BUS.publish(f'{self.name}/{t[len(pub) + 1:]}', value)
+        return True
+
+    def send(self, topic: hass_topic, payload):
+        # Only the lease holder speaks for the availability of a leased
+        # source, the others would mark a healthy source offline.
+        if self.lease and topic is self.topics['available'] and \
+                not self.lease.owned():
+            return
+        super().send(topic, payload)
+
+    def replay_send(self, topic: str, payload, qos: int, retain: bool):
+        # Queued while cut off from the broker. If the lease expired
+        # meanwhile, another node has published fresher data since, so
+        # drop it rather than overwrite the new holder's retained state.
+        if self.lease and not self.lease.owned():
+            return True
+        return super().replay_send(topic, payload, qos, retain)
+
+    def lease_loop(self):
+        owner = False
+        while not self.stopping:
+            if self.connected and (claim := self.lease.claim()):
+                self.publish(self.lease.topic, claim, qos=1, retain=True)
+            if owner != self.lease.owned():
+                owner = not owner
+                log(f'{self.name} lease {"taken" if owner else "lost"} '
+                    f'by {self.lease.node}')
+                self.wake()
+            time.sleep(self.lease.wait())
+
+    def run(self):
+        if self.lease:
+            Thread(target=self.lease_loop, daemon=True,
+                   name=f'{self.name}_lease').start()
+        super().run()
+
+    def disconnect(self):
+        if self.lease:
+            # Offline while still holding the lease, then hand it over
+            self.pub('available', 'offline')
+            if (payload := self.lease.release()) is not None:
+                self.publish(self.lease.topic, payload, qos=1, retain=True)
+        super().disconnect()
+
+    def sensor_topic(self, suffix: str):
+        """Sub topic of the sensor, retained if the sensor asks for it,
+        for payloads sent only on change, e.g. a chart image"""
+        retained = getattr(self.sensor, 'retain_subtopics', ())
+        return self.subtopic(suffix, retain=True if suffix in retained
+                             else None)
+
+    def sensor_subtopics(self):
+        """Sensors may publish extra payloads, e.g. a price curve, on
+        sub topics of their pub topic."""
+        try:
+            return self.sensor.subtopics()
+        except Exception as e:
+            log(f'Exception in subtopics for {self.type_name}: {e}')
+            return {}
+
+    def shared_data(self):
+        """Snapshot of the dependencies, zero copy for a single key"""
+        if len(self.bus_keys) == 1:
+            return BUS.value(self.bus_keys[0], {})
+        shared = {}
+        for key in self.bus_keys:
+            shared.update(BUS.value(key, {}))
+        return shared
+
     def action(self):
-        self.sensor.shared_data = self.shared_data
+        self.apply_reconfigure()
+        if self.lease and not self.lease.owned():
+            # Another node publishes this source
+            return True
+        self.sensor.shared_data = self.shared_data()
         try:
             result = self.sensor.update()
         except Exception as e:
@@ -168,9 +546,19 @@ class mqtt_sensor(mqtt_publisher):
             log(e)
             log(f'Exception in mqtt_sensor action for {self.type_name}')
         if result:
+            self.begin_batch()
             self.pub('available', 'online')
-            self.pub('pub', json.dumps(result))
-            log(json.dumps(result))
+            self.pub('pub', result)
+            BUS.publish(self.name, result)
+            subtopics = self.sensor_subtopics()
+            for suffix, payload in subtopics.items():
+                self.publish_topic(self.sensor_topic(suffix), payload)
+                BUS.publish(f'{self.name}/{suffix}', payload)
+            self.flush()
+            self.phase('fresh_publish')
+            if self.snapshots:
+                self.snapshots.save(self.name, result, subtopics)
+            log(encode_json(result))
             return True
         else:
             self.pub('available', 'offline')
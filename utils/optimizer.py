@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+from . import log
+from .sensors import general_sensors
+from .slots import calendar
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date
+import math
+import time
+import numpy as np
+
+
+@dataclass
+class device:
+    """A consumer to schedule. energy (kWh) is needed in every demand
+    period, which starts each day at day_start (hour). The device uses
+    power (kW) when on, may only run inside windows ([[from, to] hours],
+    to < from wraps midnight) and runs at least min_run minutes."""
+    name: str
+    energy: float
+    power: float
+    windows: list = field(default_factory=lambda: [[0, 24]])
+    min_run: int = 60
+    day_start: int = 0
+
+    def allowed(self, hours):
+        """Mask of slots inside the windows, given local hour of day"""
+        mask = np.zeros(len(hours), dtype=bool)
+        for start, end in self.windows:
+            if start <= end:
+                mask |= (hours >= start) & (hours < end)
+            else:
+                mask |= (hours >= start) | (hours < end)
+        return mask
+
+    def periods(self, days, hours):
+        """Demand period of each slot, as the local day it started"""
+        return days - (hours < self.day_start)
+
+    def period_of(self, cal, epoch: float):
+        """Demand period of an epoch, see periods()"""
+        day, i = cal.locate(epoch)
+        return day.date.toordinal() - (day.hours[i] < self.day_start)
+
+    def period_start(self, cal, period: int):
+        """Epoch of the first slot of a demand period"""
+        day = cal.day(date.fromordinal(int(period)))
+        return day.epoch(bisect_left(day.hours, self.day_start))
+
+
+class planner:
+    """
+    Joint minimum cost schedule of several devices under a site power
+    cap. Each (device, demand period) is a job, placed greedily in order
+    of least flexibility first: a job takes the cheaper of extending one
+    of its runs by a slot or starting a new min_run block, among slots
+    with power headroom left. Overshoot from the last block is repaired
+    by trimming the most expensive run ends that keep min_run.
+
+    A job's placement only depends on its own slots, prices, demand and
+    the headroom left by earlier jobs, so placements are memoized on
+    exactly that, and a re-plan only recomputes jobs whose inputs
+    changed, e.g. tomorrow's jobs when tomorrow's prices arrive.
+    """
+
+    def __init__(self, devices: list, site_cap: float = None,
+                 resolution: int = 900):
+        self.devices = devices
+        self.site_cap = site_cap or math.inf
+        self.resolution = resolution
+        self.memo: dict = {}
+
+    def prices(self, start: int, step: int, values):
+        """Price per planning slot, given a curve at another step"""
+        values = np.asarray(values, dtype=float)
+        if step > self.resolution:
+            values = np.repeat(values, step // self.resolution)
+        elif step < self.resolution:
+            k = self.resolution // step
+            values = values[:len(values) // k * k].reshape(-1, k).mean(1)
+        return values
+
+    def jobs(self, start: int, slots: int, now: int, executed: dict):
+        """(device, mask of free slots, slots still needed) per job.
+        Runs count against their period also when before the horizon,
+        e.g. last evening's runs in a period that started yesterday
+        noon. A period cut off by the end of the horizon needs only its
+        share of the energy, until later prices extend the horizon."""
+        dt = self.resolution / 3600
+        cal = calendar(self.resolution)
+        located = cal.slots(start, slots)
+        days = np.array([day.date.toordinal() for day, _ in located])
+        hours = np.array([day.hours[i] for day, i in located])
+        end = start + slots * self.resolution
+        future = np.arange(slots) >= now
+        jobs = []
+        for d in self.devices:
+            periods = d.periods(days, hours)
+            allowed = d.allowed(hours)
+            ran = Counter(d.period_of(cal, e)
+                          for e in executed.get(d.name, ()))
+            for period in np.unique(periods):
+                in_period = periods == period
+                needed = d.energy / (d.power * dt)
+                first = d.period_start(cal, period)
+                last = d.period_start(cal, period + 1)
+                if last > end:
+                    needed *= (end - first) / (last - first)
+                needed = math.ceil(needed - 1e-9) - ran[int(period)]
+                mask = in_period & allowed & future
+                jobs.append((d, mask, max(needed, 0)))
+        # Least flexible first, i.e. fewest spare slots
+        jobs.sort(key=lambda j: (int(j[1].sum()) - j[2], -j[0].power))
+        return jobs
+
+    def place(self, d: device, mask, needed: int, prices, headroom):
+        slots = len(prices)
+        m = max(1, math.ceil(d.min_run * 60 / self.resolution))
+        chosen = np.zeros(slots, dtype=bool)
+        free = mask & (headroom >= d.power - 1e-9)
+        ones = np.ones(m)
+        block_cost = np.convolve(prices, ones, 'valid') / m \
+            if slots >= m else np.array([])
+        need = needed
+        while need > 0:
+            free &= ~chosen
+            best, kind = math.inf, None
+            neighbours = np.zeros(slots, dtype=bool)
+            neighbours[1:] |= chosen[:-1]
+            neighbours[:-1] |= chosen[1:]
+            ext = free & neighbours
+            if ext.any():
+                i = int(np.argmin(np.where(ext, prices, math.inf)))
+                best, kind = prices[i], ('ext', i)
+            if len(block_cost) and (kind is None or need >= m):
+                ok = np.convolve(free, ones, 'valid') >= m - 0.5
+                if ok.any():
+                    j = int(np.argmin(np.where(ok, block_cost, math.inf)))
+                    if block_cost[j] < best:
+                        kind = ('block', j)
+            if kind is None:
+                log(f'planner can not fit {need} slots of {d.name}')
+                break
+            if kind[0] == 'ext':
+                chosen[kind[1]] = True
+                need -= 1
+            else:
+                chosen[kind[1]:kind[1] + m] = True
+                need -= m
+        if need < 0:
+            self.trim(chosen, -need, m, prices)
+        return chosen
+
+    @staticmethod
+    def trim(chosen, surplus: int, m: int, prices):
+        """Drop surplus slots from run ends, most expensive first, as
+        long as the run stays at least m long"""
+        while surplus > 0:
+            edges = np.flatnonzero(np.diff(np.r_[0, chosen.astype(int), 0]))
+            best = None
+            for a, b in zip(edges[::2], edges[1::2]):
+                if b - a > m:
+                    for i in (a, b - 1):
+                        if best is None or prices[i] > prices[best]:
+                            best = i
+            if best is None:
+                break
+            chosen[best] = False
+            surplus -= 1
+
+    def plan(self, start: int, step: int, values, now: float,
+             executed: dict):
+        """Returns (start, {device name: on/off array}) over the curve.
+        executed holds the epochs each device already ran, which count
+        against the demand of the current period."""
+        prices = self.prices(start, step, values)
+        slots = len(prices)
+        now_idx = max(int((now - start) // self.resolution), 0)
+        headroom = np.full(slots, self.site_cap, dtype=float)
+        schedule = {d.name: np.zeros(slots, dtype=bool) for d in self.devices}
+        for d in self.devices:
+            done = [e for e in executed.get(d.name, ())
+                    if start <= e < start + now_idx * self.resolution]
+            for e in done:
+                k = int((e - start) // self.resolution)
+                schedule[d.name][k] = True
+                headroom[k] -= d.power
+        memo = {}
+        for d, mask, needed in self.jobs(start, slots, now_idx, executed):
+            key = (d.name, d.power, d.min_run, needed, start,
+                   mask.tobytes(), prices[mask].tobytes(),
+                   headroom[mask].tobytes())
+            chosen = self.memo.get(key)
+            if chosen is None:
+                chosen = self.place(d, mask, needed, prices, headroom)
+            memo[key] = chosen
+            schedule[d.name] |= chosen
+            headroom[chosen] -= d.power
+        self.memo = memo
+        return prices, schedule
+
+
+class cost_optimizer(general_sensors):
+    """
+    Schedules devices over the price horizon. Reads the tariff inclusive
+    price curve from the bus, e.g. "bus": "spotprice/curve", which needs
+    "curve": true on that price source. Configure "site_cap" (kW),
+    "resolution" (minutes) and devices {name: {energy, power, windows,
+    min_run, day_start}}. Publishes on/off per device on <topic>/<name>
+    and the whole plan on <topic>/plan.
+    """
+    shared = True
+
+    def __init__(self, conf: dict):
+        super().__init__(conf)
+        self.shared_data = None
+        self.start = None
+        self.prices = None
+        self.schedule: dict = {}
+        self.states: dict = {}
+        self.executed: dict = {}
+        self.configure(conf)
+
+    def configure(self, conf: dict):
+        self.devices = [device(name, **spec)
+                        for name, spec in self.device_map.items()]
+        self.resolution = conf.get('resolution', 15) * 60
+        self.planner = planner(self.devices, conf.get('site_cap'),
+                               self.resolution)
+        self.executed = {d.name: self.executed.get(d.name, set())
+                         for d in self.devices}
+        self.schedule = {}
+        self.curve_key = None
+
+    def reconfigure(self, conf: dict):
+        """Devices, cap and resolution change in place, with a re-plan"""
+        if conf.get('bus') != self.conf.get('bus'):
+            return False
+        if conf.get('resolution', 15) * 60 == self.resolution:
+            if self.schedule:
+                self.record_executed(time.time())
+        else:
+            self.executed = {}
+        self.conf = conf
+        self.device_map = conf.get('devices') or {}
+        self.configure(conf)
+        return True
+
+    def now_index(self, now: float):
+        return int((now - self.start) // self.resolution)
+
+    def record_executed(self, now: float):
+        """Slots of the current plan that have passed have run"""
+        for name, on in self.schedule.items():
+            for i in np.flatnonzero(on[:self.now_index(now)]):
+                self.executed[name].add(self.start + int(i) * self.resolution)
+
+    def replan(self, curve, now: float):
+        t0 = time.perf_counter()
+        if self.schedule:
+            self.record_executed(now)
+        self.start = int(curve['start'])
+        self.prices, self.schedule = self.planner.plan(
+            self.start, int(curve['step']), curve['values'], now,
+            self.executed)
+        # Forget runs of periods that have ended
+        cal = calendar(self.resolution)
+        for d in self.devices:
+            first = d.period_start(cal, d.period_of(cal, now))
+            self.executed[d.name] = {e for e in self.executed[d.name]
+                                     if e >= first}
+        log(f'cost_optimizer planned {len(self.devices)} devices in '
+            f'{1000 * (time.perf_counter() - t0):.1f} ms')
+
+    def get_values(self):
+        curve = self.shared_data
+        if not curve or not curve.get('values'):
+            log('cost_optimizer has no price curve')
+            return {}
+        now = time.time()
+        key = (curve['start'], curve['step'], tuple(curve['values']))
+        if key != self.curve_key:
+            self.replan(curve, now)
+            self.curve_key = key
+        i = self.now_index(now)
+        if not 0 <= i < len(self.prices):
+            return {}
+        self.states = {name: 'on' if on[i] else 'off'
+                       for name, on in self.schedule.items()}
+        return self.states
+
+    def subtopics(self):
+        if not self.schedule:
+            return {}
+        topics = dict(self.states)
+        dt = self.resolution / 3600
+        cost = sum(float(self.prices[self.schedule[d.name]].sum())
+                   * d.power * dt for d in self.devices)
+        topics['plan'] = {'start': self.start,
+                          'step': self.resolution,
+                          'cost': round(cost / 100, 2),
+                          'devices': {name: on.astype(int).tolist()
+                                      for name, on in self.schedule.items()}}
+        return topics
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+from . import log
+from .encoding import decode, encode, get_encoder
+from pathlib import Path
+from threading import Lock
+import base64
+import json
+import time
+
+
+class outbox:
+    """
+    Store-and-forward queue for publishes made while the broker is down.
+    Records are appended as json lines to segment files in a directory,
+    so nothing is lost if the daemon dies before the broker returns.
+    On replay, state messages (anything not marked as series) are
+    coalesced to the latest payload per topic, while time-series points
+    are all kept, in order, stamped with the time they were recorded.
+    Replay is sent in bounded, rate-limited batches so a returning
+    broker is not flooded, and segments are only deleted once all their
+    records were sent.
+    """
+    segment_bytes = 256 * 1024
+    max_segments = 64
+
+    def __init__(self, path: Path, batch_size: int = 50,
+                 rate: float = 20, encoding: str = None):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.rate = rate
+        self.encoding = encoding
+        self.encoder = get_encoder(encoding)
+        self.lock = Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Replay progress, the segments being replayed and how many of
+        # their coalesced records were sent
+        self.progress_file = self.path / 'replay.json'
+        self.sealed = set(self.progress().get('segments', []))
+
+    def segments(self):
+        return sorted(self.path.glob('*.seg'))
+
+    def pending(self):
+        return bool(self.segments())
+
+    def current_segment(self):
+        segments = self.segments()
+        if segments and segments[-1].name not in self.sealed and \
+                segments[-1].stat().st_size < self.segment_bytes:
+            return segments[-1]
+        if len(segments) >= self.max_segments:
+            log(f'outbox {self.path} full, dropping oldest segment')
+            segments[0].unlink()
+        number = int(segments[-1].stem) + 1 if segments else 0
+        return self.path / f'{number:08d}.seg'
+
+    def append(self, topic: str, payload, qos=0, retain=False,
+               series=False):
+        record = {'t': topic, 'q': qos, 'r': retain, 's': series,
+                  'ts': time.time()}
+        if isinstance(payload, (bytes, bytearray)):
+            record['b'] = base64.b64encode(payload).decode()
+        else:
+            record['p'] = payload
+        with self.lock:
+            with self.current_segment().open('a') as fp:
+                fp.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def payload(record):
+        if 'b' in record:
+            return base64.b64decode(record['b'])
+        return record.get('p')
+
+    def read(self, segments):
+        records = []
+        for segment in segments:
+            with segment.open() as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        log(f'outbox skipping broken record in {segment}')
+        return records
+
+    @staticmethod
+    def coalesce(records):
+        """Keep every series point, but only the latest state per topic,
+        placed where that latest state was recorded."""
+        latest = {}
+        for i, record in enumerate(records):
+            if not record.get('s'):
+                latest[record['t']] = i
+        return [r for i, r in enumerate(records)
+                if r.get('s') or latest[r['t']] == i]
+
+    def stamp(self, record):
+        """Payload of a record, series points with their recorded time
+        as "ts", rather than arriving as if measured at replay time"""
+        payload = self.payload(record)
+        if not record.get('s'):
+            return payload
+        value = decode(self.encoding, payload)
+        if not isinstance(value, dict) or 'ts' in value:
+            return payload
+        return encode(self.encoder, dict(value, ts=record['ts']))
+
+    def progress(self):
+        try:
+            with self.progress_file.open() as fp:
+                return json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def save_progress(self, segments: list, sent: int):
+        tmp = self.progress_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'segments': segments, 'sent': sent}))
+        tmp.replace(self.progress_file)
+
+    def replay(self, send):
+        """send(topic, payload, qos, retain) must return True on success.
+        Stops at the first failure and keeps what is left for later.
+        The segments being replayed are sealed, new records go to new
+        segments, and progress is saved after every batch, so after a
+        crash the replay resumes where it was, resending at most one
+        batch."""
+        with self.lock:
+            names = [segment.name for segment in self.segments()]
+            progress = self.progress()
+            listed = progress.get('segments', [])
+            if listed and all(name in names for name in listed):
+                segments, sent = listed, progress.get('sent', 0)
+            else:
+                segments, sent = names, 0
+            self.sealed = set(segments)
+            self.save_progress(segments, sent)
+        records = self.coalesce(self.read([self.path / name
+                                           for name in segments]))
+        log(f'outbox replaying {len(records) - sent} messages from '
+            f'{self.path}')
+        for start in range(sent, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            t0 = time.monotonic()
+            for k, record in enumerate(batch):
+                if not send(record['t'], self.stamp(record),
+                            record['q'], record['r']):
+                    self.save_progress(segments, start + k)
+                    log(f'outbox replay interrupted, '
+                        f'{len(records) - start - k} messages kept')
+                    return False
+            self.save_progress(segments, start + len(batch))
+            elapsed = time.monotonic() - t0
+            time.sleep(max(len(batch) / self.rate - elapsed, 0))
+        with self.lock:
+            for name in segments:
+                (self.path / name).unlink(missing_ok=True)
+            self.progress_file.unlink(missing_ok=True)
+            self.sealed = set()
+        return True
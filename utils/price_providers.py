@@ -7,7 +7,12 @@ from datetime import datetime, timedelta
 from dateutil import parser
 import pytz
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import time
 from . import log, err
+from . import resilience
+from .slots import calendar
 
 
 class SpotpriceRequest:
@@ -16,6 +21,11 @@ class SpotpriceRequest:
     time_fmt = "%Y-%m-%dT%H:%M:%S"  # "2023-05-29T11:00:00"
     region = 'SE3'
     url = None
+    name = None
+    # Unit of the returned series: currency and factor to öre/kWh
+    # (or cent/kWh) once converted to SEK.
+    currency = 'SEK'
+    unit_scale = 1
 
     def __init__(self):
         log('SpotpriceRequest instantiated')
@@ -24,8 +34,9 @@ class SpotpriceRequest:
     def request(self, from_file: Path = None):
         log('SpotpriceRequest requesting new data')
         try:
-            r = requests.get(self.url, timeout=5)
-        except:
+            r = resilience.get(self.url)
+        except Exception as e:
+            log(f'SpotpriceRequest failed: {e}')
             return None
         if not r.status_code == 200:
             info = {'error': 'status',
@@ -66,6 +77,7 @@ class Elprisetjustnu(SpotpriceRequest):
     https://www.elprisetjustnu.se/api/v1/prices/2023/12-07_SE3.json
     """
     base_url = "https://www.elprisetjustnu.se/api/v1/prices"
+    name = 'elprisetjustnu'
 
     def __init__(self, when=datetime.now()):
         super().__init__()
@@ -113,6 +125,120 @@ class Elprisetjustnu(SpotpriceRequest):
 
 
 
+@dataclass
+class ProviderHealth:
+    """Exponentially weighted success rate and latency of a provider"""
+    success: float = 1.0
+    latency: float = 0.0
+    calls: int = 0
+    weight: float = 0.3
+
+    def record(self, ok: bool, latency: float):
+        w = self.weight
+        self.success = (1 - w) * self.success + w * (1.0 if ok else 0.0)
+        self.latency = (1 - w) * self.latency + w * latency
+        self.calls += 1
+
+    def score(self, timeout: float):
+        return self.success - 0.5 * min(self.latency / timeout, 1.0)
+
+
+class HedgedPrices:
+    """
+    Composite price provider. The healthiest provider is asked first,
+    and if it has not delivered a valid price list within the latency
+    budget, or fails, the next one is asked as well. The first valid
+    result wins. All results are normalized to SEK/100 per kWh, so
+    providers in EUR/MWh need the exchange rate in self.xrate.
+    """
+
+    def __init__(self, providers: list, latency_budget: float = 1.5,
+                 timeout: float = 15):
+        self.providers = providers
+        self.latency_budget = latency_budget
+        self.timeout = timeout
+        self.xrate = None
+        self.health = {p.name: ProviderHealth() for p in providers}
+        self.executor = ThreadPoolExecutor(max_workers=len(providers),
+                                           thread_name_prefix='hedged')
+
+    def __repr__(self):
+        return f'HedgedPrices({[p.name for p in self.providers]})'
+
+    def ordered(self):
+        """Configured order, unless a provider has earned a worse score"""
+        return sorted(self.providers,
+                      key=lambda p: -self.health[p.name].score(self.timeout))
+
+    def normalize(self, provider, prices):
+        if prices is None or len(prices) == 0:
+            return None
+        if provider.currency != 'SEK':
+            if not self.xrate:
+                log(f'HedgedPrices has no exchange rate for {provider.name}')
+                return None
+            prices = prices * self.xrate
+        return prices * provider.unit_scale
+
+    @staticmethod
+    def valid(prices):
+        """Valid when the current slot, at the list's resolution, is
+        covered"""
+        if prices is None or len(prices) == 0:
+            return False
+        step = 3600 if len(prices) < 2 else \
+            int((prices.index[1] - prices.index[0]).total_seconds())
+        day, slot = calendar(step).locate()
+        return prices.index[0].timestamp() <= day.epoch(slot) <= \
+            prices.index[-1].timestamp()
+
+    def call(self, provider, timeout):
+        resilience.set_timeout(timeout)
+        t0 = time.monotonic()
+        try:
+            prices = self.normalize(provider, provider.fetch_prices())
+        except Exception as e:
+            log(f'HedgedPrices {provider.name} failed with {e}')
+            prices = None
+        ok = self.valid(prices)
+        self.health[provider.name].record(ok, time.monotonic() - t0)
+        return prices if ok else None
+
+    def fetch_prices(self):
+        # Workers run in the executor, so hand them the timeout budget
+        # of the calling sensor thread.
+        timeout = resilience.timeout_budget()
+        queue = self.ordered()
+        pending = set()
+        deadline = time.monotonic() + self.timeout
+        while queue or pending:
+            # Launch the next provider when the previous one failed or
+            # has used up its latency budget.
+            if queue:
+                provider = queue.pop(0)
+                log(f'HedgedPrices asking {provider.name}')
+                pending.add(self.executor.submit(self.call, provider,
+                                                 timeout))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = min(self.latency_budget, remaining) if queue \
+                else remaining
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if (prices := future.result()) is not None:
+                    return prices
+        log('HedgedPrices got no valid price list from any provider')
+        return None
+
+    def health_report(self):
+        return {name: {'success': round(h.success, 3),
+                       'latency': round(h.latency, 3),
+                       'calls': h.calls}
+                for name, h in self.health.items()}
+
+
 class Nordpool(SpotpriceRequest):
     """Deprecated. The API url seems outdated"""
     url = "https://www.nordpoolgroup.com/api/marketdata/page/10"
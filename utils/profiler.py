@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+from . import log
+from .mqtt_client import hass_client, hass_topic, server_info
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from threading import Thread, Lock, get_ident, enumerate as threads
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+class sampling_profiler:
+    """
+    Statistical profiler over all threads of the process: the stacks of
+    every thread are sampled with sys._current_frames() at an interval,
+    and counted as collapsed stacks, the input format of flamegraph.pl
+    and speedscope. Nothing is hooked into the interpreter, so there is
+    no cost at all when not running, and little while running.
+    """
+    max_seconds = 300
+    min_interval = 0.001
+
+    def __init__(self, path: Path = Path('db/profiles')):
+        self.path = Path(path)
+        self.lock = Lock()
+        # "function (file)" per code object, so sampling allocates little
+        # and a function is one flamegraph node whatever line it is at
+        self.labels: dict = {}
+
+    def label(self, code):
+        if (label := self.labels.get(code)) is None:
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)})'
+            self.labels[code] = label
+        return label
+
+    def stack(self, frame):
+        names = []
+        while frame is not None:
+            names.append(self.label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self, seconds: float, interval: float):
+        me = get_ident()
+        stacks = Counter()
+        per_thread = Counter()
+        samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                name = names.get(ident, str(ident))
+                stacks[f'{name};{self.stack(frame)}'] += 1
+                per_thread[name] += 1
+            samples += 1
+            time.sleep(interval)
+        return samples, stacks, per_thread
+
+    @staticmethod
+    def allocations(snapshot, top: int):
+        """Top allocations of the daemon, not those of the profiler"""
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.statistics('lineno')[:top]
+        return [{'where': str(s.traceback[0]),
+                 'kib': round(s.size / 1024, 1),
+                 'count': s.count} for s in stats]
+
+    def run(self, seconds: float = 10, interval: float = 0.01,
+            allocations: bool = True, top: int = 10):
+        """Profile for seconds, write the collapsed stacks to a file and
+        return a compact report. Returns None if already running."""
+        if not self.lock.acquire(blocking=False):
+            log('sampling_profiler already running')
+            return None
+        try:
+            seconds = min(max(float(seconds), 0), self.max_seconds)
+            interval = max(float(interval), self.min_interval)
+            tracing = allocations and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start(10)
+            log(f'sampling_profiler running for {seconds} s')
+            samples, stacks, per_thread = self.sample(seconds, interval)
+            report = {'time': datetime.now().isoformat(),
+                      'seconds': seconds,
+                      'interval': interval,
+                      'samples': samples,
+                      'threads': dict(per_thread),
+                      'top_stacks': [{'stack': s, 'count': c}
+                                     for s, c in stacks.most_common(top)]}
+            if allocations and tracemalloc.is_tracing():
+                report['top_allocations'] = \
+                    self.allocations(tracemalloc.take_snapshot(), top)
+            if tracing:
+                tracemalloc.stop()
+            report['file'] = str(self.write(stacks))
+            return report
+        finally:
+            self.lock.release()
+
+    def write(self, stacks: Counter):
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self.path / \
+            f'profile-{datetime.now().strftime("%Y%m%d-%H%M%S")}.folded'
+        with file.open('w') as fp:
+            for stack, count in stacks.items():
+                fp.write(f'{stack} {count}\n')
+        return file
+
+
+class profile_control(hass_client):
+    """
+    Listens on a control topic, and profiles the daemon on command, e.g.
+    {"seconds": 10, "interval": 0.01, "allocations": true}. The report
+    is published on the report topic and the flamegraph input is
+    written to the profiles directory. Configured at top level as
+    "profiling": {"topic": ..., "report": ..., "path": ...}.
+    """
+
+    def __init__(self, conf: dict, server: dict):
+        super().__init__()
+        self.server = server_info(**server)
+        topic = conf.get('topic', 'spotprices/profile')
+        self.subscription_topic = topic
+        self.topics['pub'] = hass_topic(topic=conf.get('report',
+                                                       f'{topic}/report'))
+        self.topics['available'] = hass_topic(topic=f'{topic}/available')
+        self.profiler = sampling_profiler(conf.get('path', 'db/profiles'))
+
+    def on_message(self, client, userdata, msg):
+        try:
+            command = json.loads(msg.payload or b'{}')
+            if not isinstance(command, dict):
+                command = {'seconds': float(command)}
+        except (ValueError, TypeError):
+            log(f'profile_control ignoring command {msg.payload}')
+            return
+        options = {k: command[k] for k in
+                   ('seconds', 'interval', 'allocations', 'top')
+                   if k in command}
+        # Not in the network thread, which must keep running meanwhile
+        Thread(target=self.profile, kwargs=options, daemon=True,
+               name='profiler').start()
+
+    def profile(self, seconds=10, interval=0.01, allocations=True, top=10):
+        try:
+            report = self.profiler.run(seconds, interval, allocations, top)
+        except Exception as e:
+            log(f'profile_control failed: {e}')
+            return
+        if report:
+            self.pub('pub', report)
+
+    def start(self):
+        self.connect()
+        self.loop_start()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+from . import log, config
+from .mqtt_client import mqtt_sensor
+from .snapshots import since_start
+from .profiler import profile_control
+from .api import state_api
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Thread
+import json
+import time
+
+try:
+    from inotify_simple import INotify, flags
+    INOTIFY_OK = True
+except Exception:
+    INOTIFY_OK = False
+
+
+class config_watcher:
+    """Wait for changes of the config file, with inotify when available,
+    else by polling its modification time. The directory is watched,
+    since editors often replace the file rather than writing to it."""
+    poll_period = 2
+    settle = 0.2
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.mtime = self.stat()
+        self.inotify = None
+        if INOTIFY_OK:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(str(self.path.parent),
+                                       flags.CLOSE_WRITE | flags.MOVED_TO
+                                       | flags.CREATE)
+            except OSError as e:
+                log(f'config_watcher falling back to polling: {e}')
+                self.inotify = None
+
+    def stat(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def wait(self):
+        """Block until the config file has changed"""
+        while True:
+            if self.inotify:
+                events = self.inotify.read()
+                if not any(e.name == self.path.name for e in events):
+                    continue
+                time.sleep(self.settle)
+                self.inotify.read(timeout=0)
+            else:
+                time.sleep(self.poll_period)
+            if (mtime := self.stat()) != self.mtime:
+                self.mtime = mtime
+                return
+
+
+class supervisor:
+    """
+    Runs one mqtt_sensor thread per configured source, and on config
+    changes starts, stops or reconfigures only the sources whose
+    sections changed. Unchanged sources keep their connection and warm
+    caches, and e.g. a tariff edit is applied in place.
+    """
+    join_timeout = 10
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.conf: config = None
+        self.actors: dict = {}
+        self.threads: dict = {}
+
+    def load(self):
+        with self.path.open() as cf:
+            return config(cf)
+
+    @staticmethod
+    def make_actor(conf: config, name: str):
+        """Sensor construction may do I/O, so it is done concurrently"""
+        try:
+            return mqtt_sensor(conf, name)
+        except Exception as e:
+            log(f'Failed to set up source {name}: {e}')
+            return None
+
+    def start(self, conf: config, names):
+        names = list(names)
+        with ThreadPoolExecutor(max_workers=len(names) or 1) as pool:
+            actors = pool.map(lambda name: self.make_actor(conf, name), names)
+            for name, actor in zip(names, actors):
+                if actor and not actor.disabled and actor.sensor_ok():
+                    self.actors[name] = actor
+                    self.threads[name] = Thread(target=actor.run,
+                                                daemon=True,
+                                                name=f'{name}_thread')
+        for name in names:
+            if thread := self.threads.get(name):
+                print(f'Starting thread {thread.name}')
+                thread.start()
+
+    def stop(self, name: str):
+        if actor := self.actors.pop(name, None):
+            log(f'Stopping source {name}')
+            actor.stop()
+            self.threads.pop(name).join(self.join_timeout)
+
+    def apply(self, conf: config):
+        old = self.conf
+        if conf.server != old.server or conf.cluster != old.cluster:
+            changed = set(old.sources) | set(conf.sources)
+        else:
+            changed = {name for name in set(old.sources) | set(conf.sources)
+                       if old.sources.get(name) != conf.sources.get(name)}
+        restart = []
+        for name in sorted(changed):
+            actor = self.actors.get(name)
+            if name in conf.sources and actor and \
+                    not conf.sources[name].get('disable') and \
+                    actor.reconfigure(conf):
+                log(f'Reconfigured source {name} in place')
+                continue
+            self.stop(name)
+            if name in conf.sources:
+                restart.append(name)
+        self.conf = conf
+        for actor in self.actors.values():
+            actor.conf = conf
+        self.start(conf, restart)
+
+    def run(self):
+        self.conf = self.load()
+        if profiling := self.conf.get('profiling'):
+            profile_control(profiling, self.conf.server).start()
+        if api := self.conf.get('api'):
+            state_api(api).start()
+        self.start(self.conf, self.conf.sources)
+        print(f'Threads started at {since_start()} s')
+        if not self.conf.get('reload', True):
+            for thread in list(self.threads.values()):
+                thread.join()
+            return
+        watcher = config_watcher(self.path)
+        while True:
+            watcher.wait()
+            t0 = time.perf_counter()
+            try:
+                conf = self.load()
+            except (OSError, json.JSONDecodeError, KeyError) as e:
+                log(f'Ignoring broken config {self.path}: {e}')
+                continue
+            self.apply(conf)
+            log(f'Config reloaded in '
+                f'{1000 * (time.perf_counter() - t0):.0f} ms')
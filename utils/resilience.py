@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from . import log
+from dataclasses import dataclass
+from threading import Lock, local
+from urllib.parse import urlparse
+import random
+import time
+import requests
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    def __init__(self, host='', retry_in=0):
+        super().__init__(f'Circuit open for {host}, retry in {retry_in:.0f} s')
+
+
+@dataclass
+class circuit_breaker:
+    """
+    Per host breaker. After failure_threshold consecutive failures the
+    circuit opens and calls fail fast, without network access. After an
+    exponentially growing, jittered delay, a single probe call is let
+    through (half open), which closes the circuit again on success.
+    """
+    host: str
+    failure_threshold: int = 3
+    base_delay: float = 10
+    max_delay: float = 3600
+    state: str = CLOSED
+    failures: int = 0
+    opened: int = 0
+    retry_at: float = 0
+    probing: bool = False
+
+    def __post_init__(self):
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.retry_at:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                log(f'circuit_breaker {self.host} closed')
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                delay = min(self.base_delay * 2 ** self.opened,
+                            self.max_delay)
+                # Jitter, so several sources do not probe in lockstep
+                delay *= random.uniform(0.5, 1.0)
+                self.retry_at = time.monotonic() + delay
+                self.opened += 1
+                self.state = OPEN
+                log(f'circuit_breaker {self.host} open for {delay:.0f} s')
+
+    def retry_in(self):
+        return max(self.retry_at - time.monotonic(), 0)
+
+    def report(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'retry_in': round(self.retry_in()) if self.state == OPEN
+                else 0}
+
+
+breakers: dict = {}
+breakers_lock = Lock()
+budget = local()
+
+default_timeout = 5
+min_timeout = 1
+max_timeout = 30
+# Part of the update period one request may spend waiting
+budget_fraction = 0.1
+
+
+def breaker(url_or_host: str) -> circuit_breaker:
+    host = urlparse(url_or_host).netloc or url_or_host
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = circuit_breaker(host)
+        return breakers[host]
+
+
+def set_budget(update_period: float):
+    """Tie request timeouts of the calling thread to its update period"""
+    set_timeout(min(max(update_period * budget_fraction, min_timeout),
+                    max_timeout))
+
+
+def set_timeout(seconds: float):
+    budget.timeout = seconds
+
+
+def timeout_budget():
+    return getattr(budget, 'timeout', default_timeout)
+
+
+def call(host: str, function, *args, **kwargs):
+    """Run function(*args, **kwargs) guarded by the breaker of host"""
+    guard = breaker(host)
+    if not guard.allow():
+        raise CircuitOpen(guard.host, guard.retry_in())
+    try:
+        result = function(*args, **kwargs)
+    except Exception:
+        guard.failure()
+        raise
+    guard.success()
+    return result
+
+
+def get(url: str, **kwargs):
+    """requests.get guarded by the breaker of the url host. Server
+    errors count as failures, client errors do not."""
+    kwargs.setdefault('timeout', timeout_budget())
+
+    def checked_get():
+        r = requests.get(url, **kwargs)
+        if r.status_code >= 500:
+            raise requests.HTTPError(f'status {r.status_code}', response=r)
+        return r
+    try:
+        return call(url, checked_get)
+    except requests.HTTPError as e:
+        return e.response
+
+
+def report():
+    with breakers_lock:
+        return {host: b.report() for host, b in breakers.items()}
@@ -1,16 +1,41 @@
 #!/usr/bin/env python3
 
-from . import log
+from . import log, file_age
+from . import resilience
+from pathlib import Path
 import json
-import requests
+
+try:
+    import ijson
+    IJSON_OK = True
+except Exception:
+    IJSON_OK = False
 
 
 class general_sensors:
     ok = True
+    # Shared sources are owned by one node in cluster mode, local
+    # sources, e.g. w1 probes, are published by every node.
+    shared = False
+    # Sub topics published retained, see subtopics()
+    retain_subtopics = ()
 
     def __init__(self, conf: dict):
+        self.conf = conf
         self.device_map = conf.get('devices') or {}
         self.subscription_topic = conf.get('subscription')
+        # Set by the hosting mqtt_sensor, to request an immediate update
+        self.wake = None
+
+    def reconfigure(self, conf: dict):
+        """Take a changed config without restarting. By default only a
+        changed device map can be applied in place."""
+        if {k: v for k, v in conf.items() if k != 'devices'} != \
+                {k: v for k, v in self.conf.items() if k != 'devices'}:
+            return False
+        self.conf = conf
+        self.device_map = conf.get('devices') or {}
+        return True
 
     def update(self):
         return self.get_values()
@@ -19,6 +44,15 @@ class general_sensors:
         """Must be imlemented by subclass"""
         raise NotImplementedError
 
+    def stop(self):
+        """Stop any threads of the sensor"""
+        pass
+
+    def subtopics(self):
+        """Extra payloads {suffix: payload}, published on sub topics
+        of the sensor topic in the same tick as the main payload"""
+        return {}
+
 
 class http_parsers:
 
@@ -30,7 +64,10 @@ class http_parsers:
     def fetch_json(self) -> dict:
         json_response = {}
         try:
-            r = requests.get(self.url, headers=self.headers)
+            r = resilience.get(self.url, headers=self.headers)
+        except resilience.CircuitOpen as e:
+            r = None
+            log(f'http_sensors skipping sensor {self.name}. {e}')
         except Exception:
             r = None
             log(f'http_sensors requests exception for sensor {self.name}')
@@ -89,3 +126,98 @@ class http_parsers:
                     return float(sample['value'])
                 except ValueError:
                     log(f'http_parsers.smhi failed to parse one item {sample}')
+
+
+class smhi_bulk:
+    """
+    All stations of one SMHI parameter in one request, using the
+    station-set/all latest-hour document instead of one latest-day
+    document per station. Station metadata is cached on disk.
+    """
+    base_url = 'https://opendata-download-metobs.smhi.se/api/version/1.0'
+    metadata_timeout_s = 7 * 24 * 3600
+
+    def __init__(self, parameter=1, cache: Path = None):
+        self.parameter = parameter
+        self.cache = Path(cache) if cache else None
+        self.metadata: dict = None
+
+    @property
+    def url(self):
+        return (f'{self.base_url}/parameter/{self.parameter}'
+                '/station-set/all/period/latest-hour/data.json')
+
+    @property
+    def metadata_url(self):
+        return f'{self.base_url}/parameter/{self.parameter}.json'
+
+    @staticmethod
+    def stations(fp):
+        """Iterate station items of a document, streaming if ijson is
+        available, so the whole document is never held as objects"""
+        if IJSON_OK:
+            yield from ijson.items(fp, 'station.item', use_float=True)
+        else:
+            yield from json.load(fp).get('station') or []
+
+    @classmethod
+    def parse(cls, fp, wanted: dict):
+        """Latest value for each station key in wanted, as
+        {wanted[key]: value}. fp is any binary file like object, e.g. a
+        response stream or a recorded fixture."""
+        result = {}
+        for station in cls.stations(fp):
+            name = wanted.get(str(station.get('key')))
+            if name is None or not (values := station.get('value')):
+                continue
+            sample = values[-1]
+            try:
+                result[name] = float(sample['value'])
+            except (ValueError, TypeError, KeyError):
+                log(f'smhi_bulk failed to parse one item {sample}')
+            if len(result) == len(wanted):
+                break
+        return result
+
+    def fetch(self, wanted: dict):
+        try:
+            r = resilience.get(self.url, stream=True)
+        except Exception as e:
+            log(f'smhi_bulk request failed. {e}')
+            return {}
+        with r:
+            if r.status_code != 200:
+                log(f'smhi_bulk: Request error from {self.url} '
+                    f'with status {r.status_code}')
+                return {}
+            r.raw.decode_content = True
+            try:
+                return self.parse(r.raw, wanted)
+            except Exception as e:
+                log(f'smhi_bulk failed parsing {self.url}. {e}')
+                return {}
+
+    def get_metadata(self):
+        """{station key: {'name', 'active', ...}}, read from the cache
+        file when fresh enough, else fetched and cached"""
+        if self.metadata is not None:
+            return self.metadata
+        data = None
+        if self.cache and file_age(self.cache).total_seconds() \
+                < self.metadata_timeout_s:
+            with self.cache.open() as fp:
+                try:
+                    data = json.load(fp)
+                except json.JSONDecodeError:
+                    log(f'smhi_bulk failed reading cache {self.cache}')
+        if data is None:
+            http_tool = http_parsers(self.metadata_url, 'smhi_metadata')
+            if stations := http_tool.fetch_json().get('station'):
+                data = {str(s['key']): {'name': s.get('name'),
+                                        'active': s.get('active', True)}
+                        for s in stations}
+                if self.cache:
+                    with self.cache.open('w') as fp:
+                        json.dump(data, fp)
+        self.metadata = data
+        return data
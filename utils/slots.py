@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from dateutil import tz
+from threading import Lock
+import time
+
+TIME_ZONE = 'Europe/Stockholm'
+
+
+@dataclass(frozen=True)
+class delivery_day:
+    """The slots of one local day. Slots are uniform in UTC, so a 23 or
+    25 hour day simply has fewer or more of them, and the local time of
+    every slot is computed once, here."""
+    date: date
+    step: int
+    start: int  # epoch of local midnight
+    end: int  # epoch of the next local midnight
+    local: tuple  # local datetime of each slot start
+    hours: tuple  # local hour of day of each slot, fractional
+
+    def __len__(self):
+        return len(self.local)
+
+    def index(self, t: float):
+        """Slot of epoch t, -1 if t is not in this day"""
+        if self.start <= t < self.end:
+            return int((t - self.start) // self.step)
+        return -1
+
+    def epoch(self, i: int):
+        return self.start + i * self.step
+
+
+class slot_calendar:
+    """
+    Delivery days of one zone and resolution, built once per day. Time
+    to slot is integer arithmetic on the day's UTC start, so locating
+    "now" is O(1) and needs no time zone conversion while in the same
+    day, and local hour, weekday and month come from the precomputed
+    day rather than from per-price datetime work.
+    """
+    max_days = 64
+
+    def __init__(self, step: int = 3600, zone: str = TIME_ZONE):
+        self.step = int(step)
+        self.zone = zone
+        self.tz = tz.gettz(zone)
+        self.days: dict = {}
+        self.current: delivery_day = None
+        self.lock = Lock()
+
+    def midnight(self, d: date):
+        return int(datetime(d.year, d.month, d.day, tzinfo=self.tz)
+                   .timestamp())
+
+    def day(self, d: date) -> delivery_day:
+        if (day := self.days.get(d)) is None:
+            start = self.midnight(d)
+            end = self.midnight(d + timedelta(days=1))
+            local = tuple(datetime.fromtimestamp(t, self.tz)
+                          for t in range(start, end, self.step))
+            day = delivery_day(d, self.step, start, end, local,
+                               tuple(t.hour + t.minute / 60 for t in local))
+            with self.lock:
+                if len(self.days) >= self.max_days:
+                    del self.days[min(self.days)]
+                self.days[d] = day
+        return day
+
+    def day_of(self, t: float) -> delivery_day:
+        day = self.current
+        if day is None or not day.start <= t < day.end:
+            day = self.day(datetime.fromtimestamp(t, self.tz).date())
+            self.current = day
+        return day
+
+    def locate(self, t: float = None):
+        """(delivery day, slot index) of epoch t, default now"""
+        t = time.time() if t is None else t
+        day = self.day_of(t)
+        return day, day.index(t)
+
+    def slots(self, start: float, count: int):
+        """(delivery day, slot index) of count slots from epoch start"""
+        result = []
+        t = start
+        while len(result) < count:
+            day, i = self.locate(t)
+            n = min(len(day) - i, count - len(result))
+            result.extend((day, k) for k in range(i, i + n))
+            t = day.end
+        return result
+
+
+calendars: dict = {}
+
+
+def calendar(step: int = 3600, zone: str = TIME_ZONE) -> slot_calendar:
+    """The shared calendar of a resolution (seconds) and zone"""
+    key = (int(step), zone)
+    if key not in calendars:
+        calendars.setdefault(key, slot_calendar(*key))
+    return calendars[key]
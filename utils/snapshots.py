@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+from . import log
+from pathlib import Path
+import json
+import time
+
+# Reference for startup phase timings
+PROCESS_START = time.monotonic()
+
+
+def since_start():
+    return round(time.monotonic() - PROCESS_START, 3)
+
+
+class snapshot_store:
+    """
+    Last published payload of each source on disk, so that after a
+    restart the last known values can be published, marked stale, as
+    soon as the broker connection is up, before the first upstream
+    fetch. Only written when the payload changed, and at most once per
+    min_interval seconds, as time-series sources change on every
+    update. Writes are atomic, a crash leaves the previous snapshot.
+    """
+
+    def __init__(self, path: Path = Path('db/snapshots'),
+                 min_interval: float = 0):
+        self.path = Path(path)
+        self.min_interval = min_interval
+        self.saved: dict = {}
+        self.saved_at: dict = {}
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def file(self, name: str):
+        return self.path / f'{name}.json'
+
+    def save(self, name: str, payload, subtopics: dict):
+        data = {'payload': payload,
+                'subtopics': {k: v for k, v in subtopics.items()
+                              if not isinstance(v, (bytes, bytearray))},
+                'time': time.time()}
+        try:
+            text = json.dumps(data['payload'], default=str) + \
+                json.dumps(data['subtopics'], default=str)
+            if self.saved.get(name) == text:
+                return
+            now = time.monotonic()
+            if now - self.saved_at.get(name, -self.min_interval) \
+                    < self.min_interval:
+                return
+            file = self.file(name)
+            tmp = file.with_suffix('.tmp')
+            with tmp.open('w') as fp:
+                json.dump(data, fp, default=str)
+            tmp.replace(file)
+            self.saved[name] = text
+            self.saved_at[name] = now
+        except (OSError, TypeError, ValueError) as e:
+            log(f'snapshot_store failed saving {name}. {e}')
+
+    def load(self, name: str):
+        try:
+            with self.file(name).open() as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            log(f'snapshot_store failed reading {name}. {e}')
+            return None
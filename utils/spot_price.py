@@ -3,10 +3,18 @@
 from . import log, err, file_age
 # from .sensors import general_sensors
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from dateutil import tz
 from pathlib import Path
-from .price_providers import Elprisetjustnu
+from .price_providers import Elprisetjustnu, HedgedPrices
+from .encoding import price_curve
+from . import resilience
+from .slots import calendar, delivery_day
+from bisect import bisect_left
+from xml.etree.ElementTree import iterparse
+import gzip
+import json
+import time
 
 try:
     import pandas as pd
@@ -28,7 +36,7 @@ TZ = tz.gettz(TIME_ZONE)
 
 
 def day_start(time: datetime):
-    return datetime(time.year, time.month, time.day, 0, 0, 0, 0, TZ)
+    return calendar().day(time.date()).local[0]
 
 
 class PriceListException(Exception):
@@ -56,34 +64,166 @@ class TransferPrice:
         self.tax = conf_dict.get('energy_tax', 0)
         assert isinstance(self.tariff, list)
         self.currency = 'SEK/100'
+        self.days: dict = {}
         log(conf_dict)
 
     def energy_tax(self):
         return self.tax
 
-    def get(self, now: datetime):
+    def at(self, day: date, hour: float):
         morning, high = self.tariff[0]
         evening, low = self.tariff[1]
-        if now.month in range(4, 11):
+        if day.month in range(4, 11):
             return low + self.spot_add
-        elif now.weekday() in range(5, 7):
+        elif day.weekday() in range(5, 7):
             return low + self.spot_add
-        elif now.hour < morning or now.hour >= evening:
+        elif hour < morning or hour >= evening:
             return low + self.spot_add
         else:
             return high + self.spot_add
 
+    def day(self, day: delivery_day):
+        """Tariff of every slot of a delivery day, computed once"""
+        key = (day.date, day.step)
+        if (tariffs := self.days.get(key)) is None:
+            if len(self.days) > 64:
+                self.days.clear()
+            tariffs = tuple(self.at(day.date, hour) for hour in day.hours)
+            self.days[key] = tariffs
+        return tariffs
+
+    def get(self, now: datetime):
+        day, slot = calendar().locate(now.timestamp())
+        return self.day(day)[slot]
+
     def current_price(self):
         return self.get(datetime.now(TZ))
 
 
+class PriceStats:
+    """
+    Statistics of a price list, maintained so that a publish costs O(1):
+    per day summaries, sorted prices and the cheapest remaining slot
+    from every slot are computed once per new price list, and the slot
+    dependent part is computed once per slot. Summaries of complete days
+    are kept in a history file for the rolling windows.
+    """
+    windows = (7, 30)
+
+    def __init__(self, history: Path):
+        self.history_path = history
+        self.history: dict = {}
+        self.days: dict = {}
+        self.rolling: dict = {}
+        self.slot_key = None
+        self.slot_stats: dict = {}
+        try:
+            with self.history_path.open() as fp:
+                self.history = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            log(f'PriceStats starting new history {self.history_path}')
+
+    @staticmethod
+    def summary(values):
+        return {'min': round(min(values), 3),
+                'max': round(max(values), 3),
+                'mean': round(sum(values) / len(values), 3)}
+
+    def update(self, prices, days: dict):
+        """prices: tariff inclusive series of the whole horizon, days:
+        its rows per delivery day slot, see PriceList.calendar_days"""
+        self.days = {}
+        for d, (day, rows) in days.items():
+            positions, values, times = [], [], []
+            for slot, row in enumerate(rows):
+                positions.append(None if row is None else len(values))
+                if row is not None:
+                    values.append(float(prices.iloc[row]))
+                    times.append(day.local[slot].isoformat())
+            if not values:
+                continue
+            # Index of the cheapest slot at or after each slot
+            cheapest = list(range(len(values)))
+            for i in range(len(values) - 2, -1, -1):
+                if values[cheapest[i + 1]] < values[i]:
+                    cheapest[i] = cheapest[i + 1]
+            self.days[d] = {'day': day,
+                            'positions': positions,
+                            'times': times,
+                            'values': values,
+                            'sorted': sorted(values),
+                            'cheapest': cheapest,
+                            'summary': self.summary(values)}
+            if len(values) == len(day):
+                self.history[d.isoformat()] = self.days[d]['summary']
+        self.save_history()
+        self.rolling = self.rolling_windows()
+        self.slot_key = None
+
+    def save_history(self):
+        """Keeps the days of the longest window up to today, and the
+        complete days after it, i.e. tomorrow"""
+        today = datetime.now(TZ).date()
+        first = (today - timedelta(days=max(self.windows) - 1)).isoformat()
+        self.history = {day: summary for day, summary
+                        in sorted(self.history.items()) if day >= first}
+        try:
+            tmp = self.history_path.with_suffix('.tmp')
+            with tmp.open('w') as fp:
+                json.dump(self.history, fp)
+            tmp.replace(self.history_path)
+        except OSError as e:
+            log(f'PriceStats failed writing history. {e}')
+
+    def rolling_windows(self):
+        today = datetime.now(TZ).date().isoformat()
+        days = [d for d in sorted(self.history) if d <= today]
+        result = {}
+        for window in self.windows:
+            summaries = [self.history[d] for d in days[-window:]]
+            if summaries:
+                result[f'{window}d'] = {
+                    'min': min(s['min'] for s in summaries),
+                    'max': max(s['max'] for s in summaries),
+                    'mean': round(sum(s['mean'] for s in summaries)
+                                  / len(summaries), 3),
+                    'days': len(summaries)}
+        return result
+
+    def at(self, now: datetime):
+        day = self.days.get(now.date())
+        if day is None:
+            return {}
+        slot = day['day'].index(now.timestamp())
+        if slot < 0 or (slot := day['positions'][slot]) is None:
+            return {}
+        if (now.date(), slot) != self.slot_key:
+            tomorrow = self.days.get(now.date() + timedelta(days=1))
+            price = day['values'][slot]
+            below = bisect_left(day['sorted'], price)
+            cheapest = day['cheapest'][slot]
+            self.slot_stats = {
+                'today': day['summary'],
+                'tomorrow': tomorrow['summary'] if tomorrow else None,
+                'percentile': round(100 * below / len(day['sorted']), 1),
+                'cheapest_remaining': {'time': day['times'][cheapest],
+                                       'price': day['values'][cheapest]},
+                'rolling': self.rolling}
+            self.slot_key = (now.date(), slot)
+        return self.slot_stats
+
+
 class PriceList:
     cache_timeout_s = 8 * 3600
     default_price = 1000
     max_usage_hours = 24
     currency_xrate = 0
+    shared = True
+    # Config keys that can not change without a restart
+    restart_keys = ('cache', 'history', 'bus', 'subscription')
 
     def __init__(self, conf, service):
+        self.conf = conf
         self.cache: Path = Path(conf.get('cache'))
         self.service = service
         self.query_result = None
@@ -91,6 +231,16 @@ class PriceList:
         self.last_updated = datetime.now(TZ) - timedelta(days=1)
         self.update_interval = timedelta(seconds=4)
         self.tariff: TransferPrice = TransferPrice(conf)
+        self.publish_curve = conf.get('curve', False)
+        self.curve = None
+        self.totals = None
+        self.days = None
+        self.price_calendar = None
+        self.rankings: dict = {}
+        history = conf.get('history') or \
+            self.cache.with_name(f'{self.cache.stem}_history.json')
+        self.stats = PriceStats(Path(history))
+        self.stats_stale = True
 
     def change_currency(self, price_series):
         log(f'FIXME. Currency exchange rate {self.currency_xrate}')
@@ -121,7 +271,7 @@ class PriceList:
         if use_cache:
             log('reading price list')
             new_prices = self.cache_read()
-        else:
+        if new_prices is None:
             log(f'fetching price list using {self.service}')
             try:
                 new_prices = self.service.fetch_prices()
@@ -129,18 +279,86 @@ class PriceList:
                 log(f'fetch_prices failed with {e}')
             self.cache_write(new_prices)
         if new_prices is not None:
-            self.prices = self.change_currency(new_prices)
+            new_prices = self.change_currency(new_prices)
+            if self.prices is None or not new_prices.equals(self.prices):
+                self.prices = new_prices
+                self.new_price_list()
             return True
 
+    def reconfigure(self, conf):
+        """Tariff and curve changes apply in place. The price list is
+        kept, so this makes no upstream request."""
+        if any(conf.get(k) != self.conf.get(k) for k in self.restart_keys):
+            return False
+        self.conf = conf
+        self.tariff = TransferPrice(conf)
+        self.publish_curve = conf.get('curve', False)
+        self.new_price_list()
+        return True
+
+    def new_price_list(self):
+        """Drop everything derived from the previous price list"""
+        self.curve = None
+        self.totals = None
+        self.days = None
+        self.price_calendar = None
+        self.rankings = {}
+        self.stats_stale = True
+
+    @property
+    def calendar(self):
+        """Calendar of the price list resolution"""
+        if self.price_calendar is None:
+            step = 3600
+            if self.prices is not None and len(self.prices) > 1:
+                step = int((self.prices.index[1] - self.prices.index[0])
+                           .total_seconds())
+            self.price_calendar = calendar(step)
+        return self.price_calendar
+
+    def calendar_days(self):
+        """{date: (delivery day, row of each slot or None)}, mapping the
+        price list onto the calendar once per new price list"""
+        if self.days is None and self.prices is not None:
+            cal = self.calendar
+            days = {}
+            for row, t in enumerate(self.prices.index):
+                day, slot = cal.locate(t.timestamp())
+                if day.date not in days:
+                    days[day.date] = (day, [None] * len(day))
+                days[day.date][1][slot] = row
+            self.days = days
+        return self.days or {}
+
+    def rows(self, d: date):
+        """Rows of the price list in delivery day d, in slot order"""
+        entry = self.calendar_days().get(d)
+        return [row for row in entry[1] if row is not None] if entry else []
+
+    def total_prices(self):
+        """Price list with tariff, computed once per new price list"""
+        if self.totals is None and self.prices is not None:
+            values = self.prices.to_numpy(dtype=float, copy=True)
+            for day, rows in self.calendar_days().values():
+                tariffs = self.tariff.day(day)
+                for slot, row in enumerate(rows):
+                    if row is not None:
+                        values[row] += tariffs[slot]
+            self.totals = pd.Series(values, index=self.prices.index)
+        return self.totals
+
+    def price_stats(self, now: datetime):
+        if self.stats_stale:
+            self.stats.update(self.total_prices(), self.calendar_days())
+            self.stats_stale = False
+        return self.stats.at(now)
+
     def get_daily_prices(self, today=False):
-        groups = self.prices.groupby(self.prices.index.day)
-        # groupby returns a list of tuples (date, series), so filter out
-        # the actual series.
+        """Price list per local delivery day, or today's only"""
         if today:
-            for g in groups:
-                if g[0] == datetime.now(TZ).day:
-                    return g[1]
-        return [g[1] for g in groups]
+            return self.prices.iloc[self.rows(datetime.now(TZ).date())]
+        return [self.prices.iloc[self.rows(d)]
+                for d in sorted(self.calendar_days())]
 
     def get_prices(self):
         now = datetime.now(TZ)
@@ -159,13 +377,34 @@ class PriceList:
                 f'{self.tariff.get(now)} öre')
             p_now += self.tariff.get(now)
         p_now = p_now
-        return {'raw': p_raw, 'add': p_add, 'price': p_now, 'slot': slot}
+        return {'raw': p_raw, 'add': p_add, 'price': p_now, 'slot': slot,
+                'stats': self.price_stats(now)}
+
+    def get_curve(self):
+        """The whole price horizon, tariff included, as one compact
+        array payload. Rebuilt only when a new price list arrives."""
+        if self.curve is None and self.prices is not None:
+            self.curve = price_curve(self.total_prices())
+            if self.curve:
+                self.curve['unit'] = self.tariff.currency
+        return self.curve
+
+    def subtopics(self):
+        if self.publish_curve and (curve := self.get_curve()):
+            return {'curve': curve}
+        return {}
+
+    def row_at(self, now: datetime):
+        """Row of the price list for the slot of now, or None"""
+        day, slot = self.calendar.locate(now.timestamp())
+        entry = self.calendar_days().get(day.date)
+        return entry[1][slot] if entry else None
 
     def instant_price(self, now):
-        """Filter out current hourly price from price list"""
-        today = self.prices[self.prices.index.day == now.day]
-        if today.size > 0:
-            price = today[today.index.hour == now.hour].values[0]
+        """Current slot price from the price list"""
+        row = self.row_at(now)
+        if row is not None:
+            price = self.prices.iloc[row]
         else:
             price = 'Price not found in time range'
         try:
@@ -176,58 +415,199 @@ class PriceList:
             return self.default_price
 
     def todays_sorted(self, with_tariff=True):
-        today_pricelist = self.get_daily_prices(today=True)
-        if with_tariff:
-            for idx, value in today_pricelist.items():
-                today_pricelist[idx] = value + self.tariff.get(idx.to_pydatetime())
-        return today_pricelist.sort_values()
+        prices = self.total_prices() if with_tariff else self.prices
+        return prices.iloc[self.rows(datetime.now(TZ).date())].sort_values()
 
     def current_ranking(self, with_tariff=True):
-        hour = datetime.now(TZ).hour
-        for idx, item in enumerate(self.todays_sorted(with_tariff).items()):
-            if item[0].hour == hour:
-                return idx
-        return 24
+        """Position of the current slot among today's sorted prices, or
+        None without a price for it. Rankings are computed once per day
+        and price list."""
+        now = datetime.now(TZ)
+        key = (now.date(), with_tariff)
+        if key not in self.rankings:
+            prices = self.total_prices() if with_tariff else self.prices
+            rows = self.rows(now.date())
+            order = sorted(rows, key=lambda row: prices.iloc[row])
+            self.rankings[key] = {row: k for k, row in enumerate(order)}
+        return self.rankings[key].get(self.row_at(now))
+
+
+def resolution_minutes(resolution):
+    """Minutes from a resolution like "PT15M", "PT60M", "15T" or 15"""
+    if isinstance(resolution, (int, float)):
+        return int(resolution)
+    text = str(resolution).upper()
+    if text.startswith('PT') and text.endswith('H'):
+        return 60 * int(text[2:-1])
+    return int(text.strip('PTMIN'))
+
+
+def parse_day_ahead(fp, minutes: int):
+    """
+    Prices of one resolution from an A44 day-ahead document, read
+    incrementally. Periods of other resolutions are skipped without
+    collecting their points, and elements are dropped once read.
+    Positions left out (curve type A03) repeat the previous price.
+    Returns (series in UTC, resolutions seen).
+    """
+    prices: dict = {}
+    seen = set()
+    in_period = False
+    for event, elem in iterparse(fp, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag == 'Period':
+                in_period, wanted = True, None
+                period_start = period_end = position = None
+                points = []
+            continue
+        if not in_period:
+            if tag == 'TimeSeries':
+                elem.clear()
+            continue
+        if tag == 'start':
+            period_start = datetime.strptime(elem.text, '%Y-%m-%dT%H:%MZ')
+        elif tag == 'end':
+            period_end = datetime.strptime(elem.text, '%Y-%m-%dT%H:%MZ')
+        elif tag == 'resolution':
+            seen.add(elem.text)
+            wanted = resolution_minutes(elem.text) == minutes
+        elif wanted and tag == 'position':
+            position = int(elem.text)
+        elif wanted and tag == 'price.amount':
+            points.append((position, float(elem.text)))
+        elif tag == 'Period':
+            in_period = False
+            if wanted and points:
+                step = timedelta(minutes=minutes)
+                count = int((period_end - period_start) / step)
+                points = dict(points)
+                value = None
+                for k in range(count):
+                    value = points.get(k + 1, value)
+                    t = period_start + k * step
+                    if value is not None and t not in prices:
+                        prices[t] = value
+            elem.clear()
+    series = pd.Series(prices, dtype='float64').sort_index()
+    if len(series):
+        series.index = pd.DatetimeIndex(series.index).tz_localize('UTC')
+    return series, seen
 
 
 class Entsoe:
-    def __init__(self):
-        self.meter = '60T'
+    """
+    Day-ahead prices for today and tomorrow. Raw responses are kept
+    gzipped in "raw_cache", one file per (zone, period), so a restart or
+    a change of "resolution" (e.g. "PT15M") parses from disk. A cached
+    document is used until it covers the whole period, or while younger
+    than refresh_s otherwise, and when the query fails.
+    """
+    name = 'entsoe'
+    # EUR/MWh, i.e. 1/10 of cent/kWh
+    currency = 'EUR'
+    unit_scale = 0.1
+
+    host = 'web-api.tp.entsoe.eu'
+    refresh_s = 3600
+    keep_days = 14
+    # Config keys of the provider, which require a new instance
+    restart_keys = ('zone', 'resolution', 'raw_cache')
+
+    def __init__(self, conf: dict = None):
+        conf = conf or {}
+        self.zone = conf.get('zone', 'SE_3')
+        self.minutes = resolution_minutes(conf.get('resolution', 'PT60M'))
+        self.step = pd.Timedelta(minutes=self.minutes)
+        self.raw_cache = Path(conf.get('raw_cache', 'db/entsoe'))
         API_KEY = os.getenv('ENTSOE_API_KEY')
         self.client = EntsoeRawClient(api_key=API_KEY)
 
-    def fetch(self):
-        start = pd.Timestamp(datetime.now(), tz=TIME_ZONE)
-        end = pd.Timestamp(datetime.now() + timedelta(days=1),
-                           tz=TIME_ZONE)
-        country_code = 'SE_3'
+    def period(self):
+        start = pd.Timestamp(day_start(datetime.now(TZ)))
+        return start, start + pd.Timedelta(days=2)
+
+    def raw_path(self, start, end):
+        utc = '%Y%m%d%H%M'
+        return self.raw_cache / (f'{self.zone}_{start.tz_convert("UTC"):{utc}}'
+                                 f'_{end.tz_convert("UTC"):{utc}}.xml.gz')
+
+    def fetch(self, start, end):
+        self.client.timeout = resilience.timeout_budget()
         try:
-            query = \
-                self.client.query_day_ahead_prices(country_code, start, end)
+            query = resilience.call(self.host,
+                                    self.client.query_day_ahead_prices,
+                                    self.zone, start, end)
         except Exception as e:
             log(f'Exception:\n{e}')
             raise PriceListException
         return query
 
+    def store(self, path: Path, document: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with gzip.open(tmp, 'wt', compresslevel=6) as fp:
+            fp.write(document)
+        tmp.replace(path)
+        for old in path.parent.glob(f'{self.zone}_*.xml.gz'):
+            if file_age(old).days > self.keep_days:
+                old.unlink(missing_ok=True)
+
+    def parse(self, path: Path):
+        t0 = time.perf_counter()
+        with gzip.open(path, 'rb') as fp:
+            prices, seen = parse_day_ahead(fp, self.minutes)
+        log(f'Entsoe parsed {len(prices)} prices from {path.name} in '
+            f'{1000 * (time.perf_counter() - t0):.1f} ms')
+        if not len(prices):
+            log(f'Entsoe has no PT{self.minutes}M prices, only {seen}')
+            return None
+        return prices
+
+    def complete(self, prices, end):
+        return prices is not None and prices.index[-1] + self.step >= end
+
     def fetch_prices(self):
-        """The price list seems to be given in Greenwich time zone,
-           so must convert index to time zone."""
-        query_result = self.fetch()
-        if query_result is not None:
-            price_series = parsers.parse_prices(query_result)[self.meter]
-            price_series.index = price_series.index.tz_convert(TIME_ZONE)
-            return price_series
-        return None
+        """The price list is given in UTC, so the index is converted to
+           the local time zone."""
+        start, end = self.period()
+        path = self.raw_path(start, end)
+        prices = self.parse(path) if path.exists() else None
+        if not self.complete(prices, end) and \
+                (prices is None or file_age(path).total_seconds()
+                 > self.refresh_s):
+            try:
+                document = self.fetch(start, end)
+            except PriceListException:
+                document = None
+            if document:
+                self.store(path, document)
+                if (fresh := self.parse(path)) is not None:
+                    prices = fresh
+        if prices is not None:
+            prices.index = prices.index.tz_convert(TIME_ZONE)
+        return prices
 
 
 class entsoe_price_list(PriceList):
     ok = ENTSOE_OK
 
+    restart_keys = PriceList.restart_keys + Entsoe.restart_keys
+
     def __init__(self, conf: dict):
-        super().__init__(conf, Entsoe())
+        super().__init__(conf, Entsoe(conf))
         self.subscription_topic = conf.get('subscription')
         self.shared_data = None
 
+    def cache_read(self):
+        """A cached list of another resolution is read as a miss"""
+        prices = super().cache_read()
+        if prices is not None and len(prices) > 1 and \
+                prices.index[1] - prices.index[0] != self.service.step:
+            log('entsoe_price_list cache has another resolution')
+            return None
+        return prices
+
     def update(self):
         try:
             xrate = float(self.shared_data.get('eur_to_sek'))
@@ -250,3 +630,46 @@ class elprisetjustnu_price_list(PriceList):
         return self.get_prices()
 
 
+class hedged_price_list(PriceList):
+    """Price list from several providers, see HedgedPrices. Configure
+    "providers": ["elprisetjustnu", "entsoe"] in priority order and
+    optionally "latency_budget" in seconds."""
+    ok = ELPRISERJUSTNU_OK
+    restart_keys = PriceList.restart_keys + Entsoe.restart_keys + \
+        ('providers', 'latency_budget', 'timeout')
+    provider_factories = {
+        'elprisetjustnu': (lambda conf: Elprisetjustnu(), ELPRISERJUSTNU_OK),
+        'entsoe': (lambda conf: Entsoe(conf), ENTSOE_OK)}
+
+    def __init__(self, conf: dict):
+        providers = []
+        for name in conf.get('providers', ['elprisetjustnu']):
+            factory, available = \
+                self.provider_factories.get(name, (None, False))
+            if available:
+                providers.append(factory(conf))
+            else:
+                log(f'hedged_price_list skipping provider {name}')
+        self.ok = bool(providers)
+        service = HedgedPrices(providers,
+                               latency_budget=conf.get('latency_budget', 1.5),
+                               timeout=conf.get('timeout', 15))
+        super().__init__(conf, service)
+        self.subscription_topic = conf.get('subscription')
+        self.shared_data = None
+
+    def change_currency(self, price_series):
+        """HedgedPrices already normalized the result to SEK/100"""
+        return price_series
+
+    def update(self):
+        try:
+            self.service.xrate = float(self.shared_data.get('eur_to_sek'))
+        except Exception:
+            pass
+        return self.get_prices()
+
+    def subtopics(self):
+        topics = super().subtopics()
+        topics['providers'] = self.service.health_report()
+        return topics
@@ -1,6 +1,9 @@
 
 from . import log
-from .sensors import general_sensors, http_parsers
+from .sensors import general_sensors, http_parsers, smhi_bulk
+from array import array
+from threading import Thread, Event, Lock
+import time
 
 try:
     from w1thermsensor import W1ThermSensor
@@ -15,14 +18,136 @@ class MyTemperatureException(Exception):
         super().__init__(message=message)
 
 
+class sample_buffer:
+    """Fixed size ring buffer of (time, value) samples, array backed"""
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def append(self, t: float, value: float):
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, t0: float):
+        """Samples newer than t0, oldest first"""
+        start = (self.head - self.count) % self.capacity
+        samples = []
+        for i in range(self.count):
+            k = (start + i) % self.capacity
+            if self.times[k] > t0:
+                samples.append((self.times[k], self.values[k]))
+        return samples
+
+    @staticmethod
+    def aggregate(samples):
+        values = [v for _, v in samples]
+        (t_first, first), (t_last, last) = samples[0], samples[-1]
+        rate = (last - first) / (t_last - t_first) * 60 \
+            if t_last > t_first else 0.0
+        return {'min': min(values),
+                'max': max(values),
+                'mean': round(sum(values) / len(values), 3),
+                'last': last,
+                'rate': round(rate, 4),
+                'samples': len(values)}
+
+
 class temperature_sensors(general_sensors):
+    """
+    With a "sampling" section, e.g. {"period": 5, "threshold": 0.5},
+    devices are read every period seconds into a ring buffer each, and
+    each publish carries the aggregates of the samples since the last
+    one: name (last value), name_min, name_max, name_mean and name_rate
+    (per minute). A change larger than threshold since the last publish,
+    a number or {name: number}, triggers an immediate publish.
+    """
     ok = True
 
     def __init__(self, conf: dict):
         super().__init__(conf)
+        self.sampling = conf.get('sampling')
+        self.buffers: dict = {}
+        self.lock = Lock()
+        self.sampler: Thread = None
+        self.stopped = Event()
+        self.published_at = 0
+        self.published: dict = {}
 
     def get_values(self):
-        return self.get_temperatures()
+        if not self.sampling:
+            return self.get_temperatures()
+        if self.sampler is None or not self.sampler.is_alive():
+            if self.sampler is not None:
+                log('temperature_sensors restarting the sampler')
+            self.sampler = Thread(target=self.sample, daemon=True,
+                                  name='temperature_sampler')
+            self.sampler.start()
+        return self.aggregates()
+
+    def threshold(self, name: str):
+        threshold = self.sampling.get('threshold')
+        if isinstance(threshold, dict):
+            return threshold.get(name)
+        return threshold
+
+    def sample(self):
+        period = self.sampling.get('period', 5)
+        capacity = self.sampling.get('capacity', 1024)
+        while not self.stopped.is_set():
+            t0 = time.time()
+            triggered = False
+            try:
+                temperatures = self.get_temperatures()
+            except Exception as e:
+                # E.g. a w1 bus glitch, try again next period
+                log(f'temperature_sensors sampling failed: {e}')
+                temperatures = {}
+            for name, value in temperatures.items():
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                with self.lock:
+                    if name not in self.buffers:
+                        self.buffers[name] = sample_buffer(capacity)
+                    self.buffers[name].append(t0, value)
+                threshold = self.threshold(name)
+                last = self.published.get(name)
+                if threshold and last is not None and \
+                        abs(value - last) >= threshold:
+                    triggered = True
+            if triggered and self.wake:
+                self.wake()
+            self.stopped.wait(max(period - (time.time() - t0), 0))
+
+    def aggregates(self):
+        result = {}
+        with self.lock:
+            windows = {name: buffer.since(self.published_at)
+                       for name, buffer in self.buffers.items()}
+            self.published_at = time.time()
+        for name, samples in windows.items():
+            if not samples:
+                continue
+            stats = sample_buffer.aggregate(samples)
+            result[name] = stats['last']
+            for key in ('min', 'max', 'mean', 'rate'):
+                result[f'{name}_{key}'] = stats[key]
+            self.published[name] = stats['last']
+        if not result and not self.buffers:
+            # Nothing sampled yet, read directly
+            result = self.get_temperatures()
+            self.published.update(result)
+        return result
+
+    def stop(self):
+        self.stopped.set()
 
     def get_temperatures(self):
         """Must be imlemented by subclass"""
@@ -69,3 +194,41 @@ class w1_sensors(temperature_sensors):
         else:
             log('No w1_sensors result since kernel modules fails')
         return result
+
+
+class smhi_sensors(temperature_sensors):
+    """
+    Several SMHI stations from one bulk request, see smhi_bulk.
+    devices maps station key to name, e.g. {"97100": "smhi"}.
+    """
+    shared = True
+
+    def __init__(self, conf: dict):
+        super().__init__(conf)
+        self.device_map = {str(k): v for k, v in self.device_map.items()}
+        self.bulk = smhi_bulk(conf.get('parameter', 1), conf.get('cache'))
+        self.checked = False
+
+    def reconfigure(self, conf: dict):
+        if not super().reconfigure(conf):
+            return False
+        self.device_map = {str(k): v for k, v in self.device_map.items()}
+        self.checked = False
+        return True
+
+    def check_stations(self):
+        """Drop configured stations that SMHI does not know or has
+        closed. Done once, from cached metadata when available."""
+        if self.checked:
+            return
+        if metadata := self.bulk.get_metadata():
+            for key, name in list(self.device_map.items()):
+                station = metadata.get(key)
+                if station is None or not station.get('active'):
+                    log(f'smhi_sensors: station {key} ({name}) unavailable')
+                    del self.device_map[key]
+            self.checked = True
+
+    def get_temperatures(self):
+        self.check_stations()
+        return self.bulk.fetch(self.device_map)